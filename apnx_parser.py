@@ -4,17 +4,50 @@
 # This file is released under the GPLv2 license.
 #     Copyright (C) 2012 Matt Brown <matt@mattb.net.nz>
 #
+from array import array
 from bisect import bisect_right
+from collections import OrderedDict
 import json
 import logging
+import mmap
+import os
+import re
 import struct
 import sys
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 if sys.hexversion < 0x02070000:
     sys.exit("Python 2.7 or newer is required to run this program.")
 
+import batch
+
 logger = logging.getLogger().getChild('apnx_parser')
 
+# Default page size used when generating page numbers for a book. This is
+# close to the number of characters on a typical paperback page.
+DEFAULT_CHARS_PER_PAGE = 2300
+DEFAULT_LINE_LENGTH = 70
+
+# Splits text into markup tags and the text between them.
+TOKEN_RE = re.compile(r'<[^>]*>|[^<]+|<')
+# Tags which end a line of text, when counting pages by lines.
+LINE_BREAK_TAG_RE = re.compile(
+        r'</?(?:p|div|br|h[1-6]|li|tr|blockquote|hr)\b', re.I)
+
+_STRUCTS = {}
+
+
+def _GetStruct(format_str):
+    """Returns a cached, precompiled struct.Struct for format_str."""
+    s = _STRUCTS.get(format_str)
+    if s is None:
+        s = _STRUCTS[format_str] = struct.Struct(format_str)
+    return s
+
 
 class ApnxException(Exception):
     pass
@@ -257,22 +290,134 @@ class PageLabelIndex(object):
         return self._total_pages
 
 
+class EditionPageIndex(object):
+    """Maps positions in an edition to ordinal pages and page labels.
+
+    Built once per edition from its page positions and page map, so that each
+    lookup is a single bisect over the sorted positions.
+    """
+
+    def __init__(self, page_positions, page_label_idx):
+        pp = sorted((position, page)
+                    for page, position in enumerate(page_positions))
+        self._positions = [t[0] for t in pp]
+        self._pages = [t[1] for t in pp]
+        self._page_label_idx = page_label_idx
+        self._first_page = page_label_idx.first_page_with_label
+        self._last_page = page_label_idx.last_page_with_label
+        self._label_table = None
+        self._np_positions = None
+        self._np_pages = None
+        self._np_labels = None
+
+    def GetPageForPosition(self, position):
+        """Returns the ordinal page for position, clamped to labelled pages.
+
+        As with PageLabelIndex.GetLabelForPage, the returned page is one less
+        than the ordinal page number.
+        """
+        i = bisect_right(self._positions, position)
+        page = 0
+        if i:
+            page = self._pages[i-1]
+        if page < self._first_page:
+            page = self._first_page - 1
+        elif page > self._last_page:
+            page = self._last_page - 1
+        return page
+
+    def GetLabelForPosition(self, position):
+        return self._page_label_idx.GetLabelForPage(
+                self.GetPageForPosition(position))
+
+    def _GetLabelTable(self):
+        """Returns a list of labels for pages -1 to total-1, at index page+1.
+
+        This covers every page that GetPageForPosition can return.
+        """
+        if self._label_table is None:
+            self._label_table = [
+                    self._page_label_idx.GetLabelForPage(page)
+                    for page in xrange(-1, self._page_label_idx.total_pages)]
+        return self._label_table
+
+    def GetPagesForPositions(self, positions):
+        """Returns the ordinal page for each of positions.
+
+        Equivalent to calling GetPageForPosition on each position, but done
+        with a single vectorized search when numpy is available, in which case
+        a numpy array is returned.
+        """
+        if numpy is None:
+            return [self.GetPageForPosition(p) for p in positions]
+        if self._np_positions is None:
+            self._np_positions = numpy.array(self._positions,
+                                             dtype=numpy.int64)
+            self._np_pages = numpy.array(self._pages, dtype=numpy.int64)
+        i = numpy.searchsorted(self._np_positions,
+                               numpy.asarray(positions, dtype=numpy.int64),
+                               side='right')
+        pages = numpy.zeros(len(i), dtype=numpy.int64)
+        if len(self._np_pages):
+            found = i > 0
+            pages[found] = self._np_pages[i[found] - 1]
+        return numpy.where(
+                pages < self._first_page, self._first_page - 1,
+                numpy.where(pages > self._last_page, self._last_page - 1,
+                            pages))
+
+    def GetLabelsForPositions(self, positions):
+        """Returns (pages, labels) for each of positions.
+
+        pages is as returned by GetPagesForPositions, labels is a list.
+        """
+        pages = self.GetPagesForPositions(positions)
+        if numpy is None:
+            table = self._GetLabelTable()
+            return pages, [table[page + 1] for page in pages]
+        if self._np_labels is None:
+            self._np_labels = numpy.array(self._GetLabelTable(), dtype=object)
+        return pages, self._np_labels[pages + 1].tolist()
+
+    @property
+    def page_label_idx(self):
+        return self._page_label_idx
+
+
 class BinaryFile(object):
     """Helper to perform basic binary object reads from a file.
 
     Keeps track of the current position in the file, and increments
     appropriately after each read.
+
+    If use_mmap is True the file is memory mapped rather than read into
+    memory, and values are unpacked directly from the mapping.
     """
 
-    def __init__(self, filename):
-        self.data_file = open(filename, 'rb').read()
+    def __init__(self, filename, use_mmap=False):
+        with open(filename, 'rb') as fp:
+            if use_mmap and os.fstat(fp.fileno()).st_size:
+                self.data_file = mmap.mmap(fp.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+            else:
+                self.data_file = fp.read()
         self.end = len(self.data_file)
         self.pos = 0
 
+    def close(self):
+        """Release the file data, unmapping it if it was memory mapped.
+
+        Nothing more can be read from the file once it is closed.
+        """
+        if isinstance(getattr(self, 'data_file', None), mmap.mmap):
+            self.data_file.close()
+        self.data_file = None
+
     def _Unpack(self, format_str):
+        s = _GetStruct(format_str)
         start = self.pos
-        self.pos += struct.calcsize(format_str)
-        return struct.unpack(format_str, self.data_file[start:self.pos])
+        self.pos += s.size
+        return s.unpack_from(self.data_file, start)
 
     def ReadByte(self):
         return self._Unpack('B')[0]
@@ -299,9 +444,12 @@ class ApnxFile(BinaryFile):
 
     MAX_IN_MEMORY_POSITION = 2147483647
 
-    def __init__(self, filename):
+    # Array typecodes for position widths which can be decoded in bulk.
+    POSITION_TYPECODES = {1: 'B', 2: 'H', 4: 'I'}
+
+    def __init__(self, filename, use_mmap=False):
         """Load and parse the bytes in filename."""
-        BinaryFile.__init__(self, filename)
+        BinaryFile.__init__(self, filename, use_mmap)
         self._metadataRead = False
 
     def _ReadHeader(self):
@@ -314,11 +462,14 @@ class ApnxFile(BinaryFile):
                     'Unsupported page numbering file format version %s',
                     self._header_version);
         self._num_editions = self.ReadUShort()
-        self._edition_offset = []
-        for i in xrange(0, self._num_editions):
-            self._edition_offset.append(self.ReadUInt())
+        self._edition_offset = list(
+                self._Unpack('>%dI' % self._num_editions))
         metadata_len = self.ReadUInt()
         self._header_metadata = self.ReadBytes(metadata_len)
+        self._InitEditions()
+        self._metadataRead = True;
+
+    def _InitEditions(self):
         self._edition_data_offset = [0] * self._num_editions
         self._edition_pagination_format = [0] * self._num_editions
         self._edition_page_count = [0] * self._num_editions
@@ -326,7 +477,37 @@ class ApnxFile(BinaryFile):
         self._edition_positions = [None] * self._num_editions
         self._edition_json = [''] * self._num_editions
         self._edition_read = [False] * self._num_editions
-        self._metadataRead = True;
+        self._edition_page_idx = [None] * self._num_editions
+
+    @classmethod
+    def FromPagePositions(cls, positions, asin='', page_map='(1,a,1)'):
+        """Create a sidecar in memory, with one edition of the given pages.
+
+        positions is an iterable of the position at which each page starts.
+        """
+        sidecar = cls.__new__(cls)
+        sidecar.data_file = ''
+        sidecar.end = 0
+        sidecar.pos = 0
+        sidecar._header_version = 1
+        sidecar._num_editions = 1
+        sidecar._edition_offset = [0]
+        sidecar._header_metadata = json.dumps({
+                'contentGuid': '', 'asin': asin, 'cdeType': 'EBOK',
+                'fileRevisionId': '1'})
+        sidecar._InitEditions()
+        sidecar._metadataRead = True
+        positions = array('I', positions)
+        if positions:
+            sidecar._CheckPagePosition(max(positions))
+        sidecar._edition_pagination_format[0] = 1
+        sidecar._edition_page_count[0] = len(positions)
+        sidecar._edition_position_width[0] = 32
+        sidecar._edition_positions[0] = positions
+        sidecar._edition_json[0] = json.dumps({'asin': asin,
+                                               'pageMap': page_map})
+        sidecar._edition_read[0] = True
+        return sidecar
 
     def _ReadEditionFormatVersion(self, edition_idx):
         self._ReadHeader()
@@ -365,17 +546,32 @@ class ApnxFile(BinaryFile):
         self._edition_read[edition_idx] = True
 
     def _ReadEditionPositions(self, edition_idx):
-        if self._edition_positions[edition_idx]:
+        self._ReadHeader()
+        if self._edition_positions[edition_idx] is not None:
             return
         self._ReadEdition(edition_idx)
         pages = self._edition_page_count[edition_idx]
         pos_width = self._edition_position_width[edition_idx] / 8
-        positions = {}
         self.pos = self._edition_data_offset[edition_idx]
-        for page in xrange(0, pages):
-            page_pos = self._ReadPosition(pos_width)
-            self._CheckPagePosition(page_pos)
-            positions[page] = page_pos
+        typecode = self.POSITION_TYPECODES.get(pos_width)
+        if typecode:
+            # Decode the whole table straight from the file data.
+            if self.pos + pages * pos_width > self.end:
+                raise ApnxException('Truncated page positions for edition %d' %
+                                    edition_idx)
+            positions = array(typecode)
+            positions.fromstring(buffer(self.data_file, self.pos,
+                                        pages * pos_width))
+            if pos_width > 1 and sys.byteorder == 'little':
+                positions.byteswap()
+            if typecode != 'I':
+                positions = array('I', positions)
+            self.pos += pages * pos_width
+        else:
+            positions = array('I', [self._ReadPosition(pos_width)
+                                    for page in xrange(0, pages)])
+        if positions:
+            self._CheckPagePosition(max(positions))
         self._edition_positions[edition_idx] = positions
 
     def _ReadPosition(self, pos_width):
@@ -412,34 +608,111 @@ class ApnxFile(BinaryFile):
         return self._edition_json[edition_idx]
 
     def GetPagePositions(self, edition_idx):
+        """Returns an array of the position of each page in the edition."""
         self._ReadEditionPositions(edition_idx)
         return self._edition_positions[edition_idx]
 
+    def GetEditionPageIndex(self, edition_idx=0):
+        """Returns the (cached) EditionPageIndex for edition_idx."""
+        self._ReadHeader()
+        self._CheckEditionIndex(edition_idx)
+        page_idx = self._edition_page_idx[edition_idx]
+        if page_idx is None:
+            try:
+                json_obj = json.loads(self.GetEditionJSON(edition_idx))
+            except ValueError:
+                json_obj = {}
+            page_label_idx = PageLabelIndex(
+                    json_obj.get('pageMap', ''),
+                    self.GetEditionPageCount(edition_idx))
+            page_idx = EditionPageIndex(self.GetPagePositions(edition_idx),
+                                        page_label_idx)
+            self._edition_page_idx[edition_idx] = page_idx
+        return page_idx
+
     def GetPageLabelForPosition(self, position, edition_idx=0):
-        try:
-            json_obj = json.loads(self.GetEditionJSON(edition_idx))
-        except ValueError:
-            json_obj = {}
-        pp = [(t[1], t[0])
-                for t in self.GetPagePositions(edition_idx).iteritems()]
-        pp.sort()
-        page_label_idx = PageLabelIndex(
-                json_obj.get('pageMap', ''),
-                self.GetEditionPageCount(edition_idx))
-        i = bisect_right([t[0] for t in pp], position)
-        page = 0
-        if i:
-            page = pp[i-1][1]
-        if page < page_label_idx.first_page_with_label:
-            page = page_label_idx.first_page_with_label - 1
-        elif page > page_label_idx.last_page_with_label:
-            page = page_label_idx.last_page_with_label -1
-        label = page_label_idx.GetLabelForPage(page)
-        return label
+        return self.GetEditionPageIndex(edition_idx).GetLabelForPosition(
+                position)
+
+    def GetPageLabelsForPositions(self, positions, edition_idx=0):
+        """Returns (ordinal pages, page labels) for a sequence of positions.
+
+        positions may be any sequence or a numpy array. Each result matches
+        that of GetPageLabelForPosition for the same position.
+        """
+        return self.GetEditionPageIndex(edition_idx).GetLabelsForPositions(
+                positions)
 
     def HasPageNumbers(self):
         return self.num_editions > 0
 
+    def Write(self, filename):
+        """Write the supported editions of the sidecar to an .apnx file."""
+        self.Load()
+        editions = [i for i in xrange(0, self._num_editions)
+                    if self._edition_positions[i] is not None]
+        offset = 4 + 4 * len(editions) + 4 + len(self._header_metadata)
+        header = [struct.pack('>HH', self._header_version, len(editions))]
+        body = []
+        for edition_idx in editions:
+            positions = self._edition_positions[edition_idx]
+            json_txt = self._edition_json[edition_idx]
+            if len(positions) > 0xFFFF:
+                raise ApnxException('Too many pages to write for edition %d: '
+                                    '%d' % (edition_idx, len(positions)))
+            header.append(struct.pack('>I', offset))
+            positions = array('I', positions)
+            if sys.byteorder == 'little':
+                positions.byteswap()
+            edition = (struct.pack('>HHHH', 1, len(json_txt), len(positions),
+                                   32) + json_txt + positions.tostring())
+            body.append(edition)
+            offset += len(edition)
+        header.append(struct.pack('>I', len(self._header_metadata)))
+        header.append(self._header_metadata)
+        tmp_filename = '%s.tmp' % filename
+        fp = open(tmp_filename, 'wb')
+        try:
+            fp.write(''.join(header + body))
+        finally:
+            fp.close()
+        os.rename(tmp_filename, filename)
+
+    def Load(self):
+        """Decode the header and all supported editions up front.
+
+        Once loaded, the raw file data is no longer needed, so it is released
+        (and any memory mapping of the file closed).
+        """
+        self._ReadHeader()
+        for edition_idx in xrange(0, self._num_editions):
+            if self.GetEditionPaginationFormat(edition_idx) == 1:
+                self._ReadEditionPositions(edition_idx)
+        self.close()
+
+    def __getstate__(self):
+        """Pickle the decoded sidecar, without the raw file data."""
+        if self.data_file is not None:
+            # Not loaded yet; Load releases the data once it is decoded.
+            self.Load()
+        state = self.__dict__.copy()
+        del state['data_file']
+        # The page indexes are cheap to rebuild, so don't store them.
+        state.pop('_edition_page_idx', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data_file = None
+        if self._metadataRead:
+            self._edition_page_idx = [None] * self._num_editions
+            # Older pickles stored positions as a dict of page => position.
+            for i, positions in enumerate(self._edition_positions):
+                if isinstance(positions, dict):
+                    self._edition_positions[i] = array(
+                            'I', [positions[page]
+                                  for page in xrange(len(positions))])
+
     @property
     def header_version(self):
         self._ReadHeader()
@@ -456,52 +729,143 @@ class ApnxFile(BinaryFile):
         return self._num_editions
 
 
-def main():
-    if len(sys.argv) < 2:
-        logging.fatal('You must specify a book to parse!')
-        sys.exit(1)
+def GeneratePagePositions(chunks, chars_per_page=None, lines_per_page=None,
+                          line_length=DEFAULT_LINE_LENGTH):
+    """Yield the position at which each page starts in a stream of text.
 
-    logging.basicConfig()
-    if sys.argv[1] == '-d':
-        logger.setLevel(logging.DEBUG)
-        sys.argv.remove('-d')
-
-    sidecar = ApnxFile(sys.argv[1])
-    
-    print '%s\n----------' % sys.argv[1]
-    print 'Header Version: %d' % sidecar.header_version
-    print 'Header Metadata: %s' % sidecar.header_metadata
-    print 'Number of Editions: %s' % sidecar.num_editions
-    for edition_idx in xrange(0, sidecar.num_editions):
+    chunks is an iterable of strings (such as the text records of a book),
+    which is read through once, holding only one chunk at a time. Markup is
+    not counted. Pages are either chars_per_page characters long, or
+    lines_per_page lines of line_length characters, with block level tags
+    ending a line.
+    """
+    if bool(chars_per_page) == bool(lines_per_page):
+        raise ApnxException('Exactly one of characters or lines per page '
+                            'must be given')
+    if lines_per_page:
+        page_size = lines_per_page * line_length
+    else:
+        page_size = chars_per_page
+    yield 0
+    used = 0
+    pending = ''
+    base = 0  # Position of the start of pending.
+    for chunk in chunks:
+        text = pending + chunk
+        # Leave any tag that is split over two chunks for the next one.
+        end = len(text)
+        lt = text.rfind('<')
+        if lt >= 0 and text.find('>', lt) < 0 and end - lt < 4096:
+            end = lt
+        for m in TOKEN_RE.finditer(text, 0, end):
+            token = m.group()
+            if token[0] == '<' and len(token) > 1:
+                if lines_per_page and LINE_BREAK_TAG_RE.match(token):
+                    # Round up to the start of the next line.
+                    used = -(-used // line_length) * line_length
+                continue
+            pos = m.start()
+            n = len(token)
+            while used + n > page_size:
+                taken = page_size - used
+                pos += taken
+                n -= taken
+                used = 0
+                yield base + pos
+            used += n
+        pending = text[end:]
+        base += end
+
+
+def DescribeSidecar(filename):
+    """Returns an OrderedDict describing the sidecar in filename.
+
+    Every edition is described, including the position and label of each of
+    its pages. If the sidecar can't be read, the error is returned under
+    'error' instead.
+    """
+    info = OrderedDict([('file', filename)])
+    try:
+        sidecar = ApnxFile(filename)
+        info['header_version'] = sidecar.header_version
+        info['header_metadata'] = sidecar.header_metadata
+        info['editions'] = []
+        for edition_idx in xrange(0, sidecar.num_editions):
+            page_count = sidecar.GetEditionPageCount(edition_idx)
+            try:
+                json_obj = json.loads(sidecar.GetEditionJSON(edition_idx))
+            except ValueError:
+                json_obj = {}
+            page_label_idx = PageLabelIndex(json_obj.get('pageMap', ''),
+                                            page_count)
+            edition = OrderedDict([
+                    ('format',
+                     sidecar.GetEditionPaginationFormat(edition_idx)),
+                    ('page_count', page_count),
+                    ('page_map', json_obj.get('pageMap')),
+                    ('arabic_only', page_label_idx.arabic_only),
+                    ('largest_page_label',
+                     page_label_idx.largest_page_label),
+                    ('sequences', []),
+                    ('positions',
+                     list(sidecar.GetPagePositions(edition_idx))),
+                    ('labels', [page_label_idx.GetLabelForPage(page)
+                                for page in xrange(0, page_count)])])
+            for scheme in page_label_idx.schemes:
+                edition['sequences'].append(OrderedDict([
+                        ('label_range', scheme.label_range),
+                        ('description', scheme.label_type.description),
+                        ('first_ordinal_page', scheme.first_ordinal_page),
+                        ('first_page_label', scheme.first_page_label),
+                        ('last_ordinal_page', scheme.last_ordinal_page),
+                        ('last_page_label', scheme.last_page_label)]))
+            info['editions'].append(edition)
+    except Exception, e:
+        info['error'] = '%s: %s' % (e.__class__.__name__, e)
+    return info
+
+
+def PrintSidecar(info):
+    print '%s\n----------' % info['file']
+    if 'error' in info:
+        print 'Error: %s' % info['error']
+        return
+    print 'Header Version: %d' % info['header_version']
+    print 'Header Metadata: %s' % info['header_metadata']
+    print 'Number of Editions: %s' % len(info['editions'])
+    for edition_idx, edition in enumerate(info['editions']):
         print '----- Edition %d -----' % edition_idx
-        print ('Edition File format verson: %d' %
-               sidecar.GetEditionPaginationFormat(edition_idx))
-        print 'Page Count: %d' % sidecar.GetEditionPageCount(edition_idx)
-        try:
-            json_obj = json.loads(sidecar.GetEditionJSON(edition_idx))
-        except ValueError:
-            json_obj = {}
-        print 'Page Map: %s' % json_obj.get('pageMap',
-                                            '!!MISSING!! Broken metadata!')
-        page_positions = sidecar.GetPagePositions(edition_idx)
-        page_label_idx = PageLabelIndex(
-                json_obj.get('pageMap', ''),
-                sidecar.GetEditionPageCount(edition_idx))
-        print 'Arabic Only?: %s' % page_label_idx.arabic_only
-        print 'Largest Page Label: %s' % page_label_idx.largest_page_label
-        print 'Num Sequences: %d' % len(page_label_idx.schemes)
-        for scheme in page_label_idx.schemes:
-            print 'Sequence -- start: %s, end: %s' % scheme.label_range
-            print ' %s' % scheme.label_type.description
+        print 'Edition File format verson: %d' % edition['format']
+        print 'Page Count: %d' % edition['page_count']
+        print 'Page Map: %s' % (edition['page_map'] or
+                                '!!MISSING!! Broken metadata!')
+        print 'Arabic Only?: %s' % edition['arabic_only']
+        print 'Largest Page Label: %s' % edition['largest_page_label']
+        print 'Num Sequences: %d' % len(edition['sequences'])
+        for scheme in edition['sequences']:
+            print 'Sequence -- start: %s, end: %s' % scheme['label_range']
+            print ' %s' % scheme['description']
             print '  first ordinal page: %d, first page label: %s' % (
-                    scheme.first_ordinal_page, scheme.first_page_label)
+                    scheme['first_ordinal_page'], scheme['first_page_label'])
             print '  last ordinal page: %d, last page label: %s' % (
-                    scheme.last_ordinal_page, scheme.last_page_label)
-        for page in xrange(0, sidecar.GetEditionPageCount(edition_idx)):
+                    scheme['last_ordinal_page'], scheme['last_page_label'])
+        for page, (position, label) in enumerate(zip(edition['positions'],
+                                                     edition['labels'])):
             print 'ordinal page: %d, position %d, page label: "%s"' % (
-                page+1, page_positions[page],
-                page_label_idx.GetLabelForPage(page))
+                page+1, position, label)
+
+
+def main():
+    logging.basicConfig()
+    options, args = batch.ParseOptions(sys.argv, 'sidecars')
+    if len(args) < 2:
+        logging.fatal('You must specify a book to parse!')
+        sys.exit(1)
+    if options.debug:
+        logger.setLevel(logging.DEBUG)
+    batch.RunBatch(options, args[1:], ('.apnx',), DescribeSidecar,
+                   PrintSidecar)
 
 
 if __name__ == '__main__':
-    main()        
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Shared batch mode for the command line tools which describe files.
+#
+# This file is released under the GPLv2 license.
+#     Copyright (C) 2012 Matt Brown <matt@mattb.net.nz>
+#
+from multiprocessing import Pool
+import itertools
+import json
+import optparse
+import os
+import sys
+
+
+def IterInputFiles(args, extensions):
+    """Yield the files named by args, for a batch of files on the command line.
+
+    Each of args is a file, a directory (searched recursively for files with
+    one of extensions) or '-' to read a list of files from stdin, one per line.
+    """
+    for arg in args:
+        if arg == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield line.strip()
+        elif os.path.isdir(arg):
+            for dirpath, dirnames, filenames in os.walk(arg):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith(extensions):
+                        yield os.path.join(dirpath, filename)
+        else:
+            yield arg
+
+
+def ParseOptions(args, noun):
+    """Parse the options of a batch tool, which reads noun from each file."""
+    parser = optparse.OptionParser(
+            usage='%prog [options] FILE|DIR|- [FILE|DIR|- ...]')
+    parser.add_option('-d', '--debug', action='store_true', dest='debug',
+                      help='enable debug logging')
+    parser.add_option('-j', '--jobs', action='store', type='int',
+                      dest='jobs', default=1,
+                      help='Number of processes to read %s with' % noun)
+    parser.add_option('--json', action='store_true', dest='json',
+                      help='print one JSON object per file')
+
+    return parser.parse_args(args)
+
+
+def FormatJSON(info):
+    """Return info as a line of JSON.
+
+    If info can't be serialized (e.g. it holds bytes which aren't UTF-8), the
+    error is reported in place of the file's other fields.
+    """
+    try:
+        return json.dumps(info)
+    except (TypeError, ValueError), e:
+        filename = info['file']
+        if isinstance(filename, str):
+            filename = filename.decode('utf-8', 'replace')
+        return json.dumps({'file': filename,
+                           'error': '%s: %s' % (e.__class__.__name__, e)})
+
+
+def RunBatch(options, args, extensions, describe, printer):
+    """Describe each file named by args, printing the results in order.
+
+    describe(filename) must be a module level function (so that it can run in
+    a worker process) which returns a dict with at least a 'file' key, and
+    printer(info) prints it as text when options.json isn't set.
+    """
+    filenames = IterInputFiles(args, extensions)
+    pool = None
+    if options.jobs > 1:
+        pool = Pool(options.jobs)
+        results = pool.imap(describe, filenames, 4)
+    else:
+        results = itertools.imap(describe, filenames)
+    try:
+        for info in results:
+            if options.json:
+                print FormatJSON(info)
+            else:
+                printer(info)
+            sys.stdout.flush()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
@@ -3,9 +3,14 @@
 # This file is released under the GPLv2 license.
 #     Copyright (C) 2012 Matt Brown <matt@mattb.net.nz>
 
+from bisect import bisect_right
 from datetime import datetime, timedelta, tzinfo
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import code
 import cPickle as pickle
+import hashlib
+import json
 import logging
 import optparse
 import os
@@ -13,10 +18,16 @@ import pytz
 import re
 import sys
 import time
+import unicodedata
 
 if sys.hexversion < 0x02070000:
     sys.exit("Python 2.7 or newer is required to run this program.")
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import apnx_parser
 import log_parser
 import mobibook
@@ -50,98 +61,995 @@ def PrintHMS(seconds):
         return '%s, %s' % (days, FormatHMS(hms))
 
 
-def GetBookMetadata(asin, book_dir):
+def _StatKey(path):
+    """Return (size, mtime) of path, or None if it can't be stat'd."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
+
+
+class BookLibrary(object):
+    """Index of the book files in a Kindle documents directory.
+
+    The directory (and optionally its subdirectories) is walked once, filing
+    each book file under the ASIN parsed from its name, e.g.
+    Quicksilver-asin_B000FC1PJI-type_EBOK-v_0.azw. Files whose names don't
+    contain an ASIN are only searched for an ASIN that has no parsed files.
+    """
+
+    ASIN_RE = re.compile(r'(?:^|[-_])asin_([A-Za-z0-9]+)')
+    EXTENSIONS = ('.azw', '.mobi', '.apnx')
+
+    def __init__(self, book_dir, recursive=False):
+        self.book_dir = book_dir
+        # asin => list of (filename, path), sorted by filename.
+        self._files = {}
+        # (filename, path) for files with no ASIN in their name.
+        self._unparsed = []
+        self._Scan(recursive)
+
+    def _Scan(self, recursive):
+        if not os.path.isdir(self.book_dir):
+            logger.warn('Book directory %s does not exist!', self.book_dir)
+            return
+        for dirpath, dirnames, filenames in os.walk(self.book_dir):
+            if not recursive:
+                del dirnames[:]
+            for filename in filenames:
+                if not filename.endswith(self.EXTENSIONS):
+                    continue
+                path = os.path.join(dirpath, filename)
+                m = self.ASIN_RE.search(filename)
+                if m:
+                    self._files.setdefault(m.group(1), []).append(
+                            (filename, path))
+                else:
+                    self._unparsed.append((filename, path))
+        for files in self._files.values():
+            files.sort()
+        self._unparsed.sort()
+        logger.info('Found %d books (and %d other files) in %s',
+                    len(self._files), len(self._unparsed), self.book_dir)
+
+    def GetFiles(self, asin):
+        """Return a sorted list of (filename, path) book files for asin."""
+        if asin not in self._files:
+            self._files[asin] = [f for f in self._unparsed if asin in f[0]]
+        return self._files[asin]
+
+    def GetFingerprint(self, asin):
+        """Return the paths, sizes and mtimes of the book files for asin."""
+        return tuple([(path, _StatKey(path))
+                      for _, path in self.GetFiles(asin)])
+
+    @property
+    def asins(self):
+        """ASINs parsed from the names of files in the library."""
+        return [asin for asin, files in self._files.iteritems() if files]
+
+    @property
+    def fingerprint(self):
+        """The paths, sizes and mtimes of every file in the library."""
+        paths = [path for files in self._files.values()
+                 for _, path in files]
+        paths.extend([path for _, path in self._unparsed])
+        return tuple([(path, _StatKey(path)) for path in sorted(set(paths))])
+
+
+class BookMetadata(object):
+    """The title and EXTH fields of a MobiBook, detached from its file.
+
+    The index of the book's text records and its chapters (from the NCX, if
+    it has one) are kept too, so that positions can be looked up without
+    re-reading the book.
+    """
+
+    def __init__(self, book):
+        for name in mobibook.EXTH_RMAP_STRINGS:
+            try:
+                setattr(self, name, getattr(book, name))
+            except AttributeError:
+                setattr(self, name, u'')
+        self.title = book.title
+        self.text_index = book.GetTextIndex()
+        try:
+            self.chapters = book.GetChapterIndex()
+        except Exception, e:
+            # A broken NCX only loses the chapters, not the rest of the book.
+            logger.warn('Could not read the chapters of %s: %s',
+                        self.title, e)
+            self.chapters = None
+
+
+class PickleCache(object):
+    """A dict of cache entries, persisted to filename with pickle.
+
+    If filename is None the cache is not persisted.
+    """
+
+    DESCRIPTION = 'cache'
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._entries = {}
+        self._dirty = False
+        self._Load()
+
+    def _Load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        logger.info('Reading %s from %s', self.DESCRIPTION, self.filename)
+        try:
+            fp = open(self.filename, 'rb')
+            self._entries = pickle.load(fp)
+            fp.close()
+        except Exception, e:
+            logger.error('Could not load %s from %s: %s', self.DESCRIPTION,
+                         self.filename, e)
+            self._entries = {}
+
+    def Store(self):
+        if not self.filename or not self._dirty:
+            return
+        tmp_filename = '%s.tmp' % self.filename
+        logger.info('Storing %s into %s', self.DESCRIPTION, self.filename)
+        try:
+            fp = open(tmp_filename, 'wb')
+            pickle.dump(self._entries, fp, pickle.HIGHEST_PROTOCOL)
+            fp.close()
+        except Exception, e:
+            logger.error('Could not store %s to %s: %s', self.DESCRIPTION,
+                         self.filename, e)
+            if os.path.exists(tmp_filename):
+                os.unlink(tmp_filename)
+            return
+        os.rename(tmp_filename, self.filename)
+        self._dirty = False
+
+
+class MetadataCache(PickleCache):
+    """Persistent cache of book metadata, keyed on the path of the book file.
+
+    An entry is reused for as long as the size and mtime of its file are
+    unchanged, so reports on an unchanged library only need to stat files.
+    Entries map path => ((size, mtime), metadata).
+    """
+
+    DESCRIPTION = 'book metadata cache'
+
+    def Get(self, path, loader, tag=None):
+        """Return the metadata for path, calling loader(path) if not cached.
+
+        tag distinguishes different kinds of data cached for the same path.
+        """
+        try:
+            st = os.stat(path)
+        except OSError, e:
+            logger.warn('Could not stat %s: %s', path, e)
+            return None
+        key = (st.st_size, st.st_mtime)
+        name = tag is None and path or (path, tag)
+        entry = self._entries.get(name)
+        if entry and entry[0] == key:
+            return entry[1]
+        try:
+            metadata = loader(path)
+        except Exception, e:
+            # A corrupt book shouldn't stop the report, or be re-read.
+            logger.error('Could not read metadata from %s: %s', path, e)
+            metadata = None
+        self._entries[name] = (key, metadata)
+        self._dirty = True
+        return metadata
+
+
+class ReportCache(PickleCache):
+    """Persistent cache of rendered book reports.
+
+    Whole reports are stored under the options they were rendered with, along
+    with a key identifying the state, logs and library they were rendered
+    from. The report for each book is also stored separately, so that a report
+    can be re-rendered for just the books that changed.
+    """
+
+    DESCRIPTION = 'report cache'
+
+    def GetReport(self, options, key):
+        """Return the report for options if it was rendered for key."""
+        entry = self._entries.get(('report', options))
+        if entry and entry[0] == key:
+            return entry[1]
+        return None
+
+    def SetReport(self, options, key, report):
+        self._entries[('report', options)] = (key, report)
+        self._dirty = True
+
+    def GetBook(self, asin, detailed, awake, key):
+        """Return the RenderBook result for asin if it was rendered for key."""
+        entry = self._entries.get(('book', asin, detailed, awake))
+        if entry and entry[0] == key:
+            return entry[1]
+        return None
+
+    def SetBook(self, asin, detailed, awake, key, rendered):
+        self._entries[('book', asin, detailed, awake)] = (key, rendered)
+        self._dirty = True
+
+
+class LibraryIndex(PickleCache):
+    """Persistent inverted index of the metadata of the books in a library.
+
+    The creator, publisher, subject, ISBN, ASIN and title of each book are
+    split into normalised tokens, each mapped to the set of ASINs whose field
+    contains it, so books can be found without reading the library. Books are
+    only re-indexed when the sizes or mtimes of their files change.
+    """
+
+    DESCRIPTION = 'library index'
+    FIELDS = ('creator', 'publisher', 'subject', 'isbn', 'asin', 'title')
+    TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self, filename=None):
+        super(LibraryIndex, self).__init__(filename)
+        # asin => (library fingerprint, {field: tokens}).
+        self._books = self._entries.setdefault('books', {})
+        # (field, token) => set of asins.
+        self._tokens = self._entries.setdefault('tokens', {})
+
+    @classmethod
+    def Tokenize(cls, field, text):
+        """Return the set of normalised tokens in text, for field.
+
+        Tokens are lowercased with accents stripped. ISBNs and ASINs are a
+        single token, ignoring any punctuation.
+        """
+        text = unicodedata.normalize('NFKD', unicode(text))
+        text = u''.join([c for c in text if not unicodedata.combining(c)])
+        tokens = cls.TOKEN_RE.findall(text.lower())
+        if field in ('isbn', 'asin'):
+            tokens = tokens and [u''.join(tokens)]
+        return set(tokens)
+
+    def _Remove(self, asin):
+        _, fields = self._books.pop(asin)
+        for field, tokens in fields.iteritems():
+            for token in tokens:
+                asins = self._tokens.get((field, token))
+                asins.discard(asin)
+                if not asins:
+                    del self._tokens[(field, token)]
+
+    def _Add(self, asin, fingerprint, metadata):
+        fields = {}
+        if metadata:
+            for field in self.FIELDS:
+                fields[field] = self.Tokenize(
+                        field, getattr(metadata, field, u''))
+        for field, tokens in fields.iteritems():
+            for token in tokens:
+                self._tokens.setdefault((field, token), set()).add(asin)
+        self._books[asin] = (fingerprint, fields)
+
+    def Update(self, library, cache, threads=1):
+        """Re-index the books in library which have changed.
+
+        Metadata is read through cache (a MetadataCache), and books no longer
+        in library are dropped from the index.
+        """
+        asins = set(library.asins)
+        for asin in [a for a in self._books if a not in asins]:
+            self._Remove(asin)
+            self._dirty = True
+        changed = {}
+        for asin in asins:
+            fingerprint = library.GetFingerprint(asin)
+            entry = self._books.get(asin)
+            if not entry or entry[0] != fingerprint:
+                changed[asin] = fingerprint
+        if not changed:
+            return
+        logger.info('Indexing %d books', len(changed))
+        books = ScanLibrary(library, cache, changed.keys(), threads)
+        for asin, fingerprint in changed.iteritems():
+            if asin in self._books:
+                self._Remove(asin)
+            self._Add(asin, fingerprint, books[asin][0])
+        self._dirty = True
+
+    def Search(self, field, query):
+        """Return the ASINs whose field contains every token of query."""
+        rv = None
+        for token in self.Tokenize(field, query):
+            asins = self._tokens.get((field, token), set())
+            rv = asins if rv is None else rv & asins
+            if not rv:
+                break
+        return set(rv or ())
+
+
+def GetReportKey(state_file, log_dir, library):
+    """Return a key identifying the inputs of a book report.
+
+    The key covers the size and mtime of the state file, of every logfile in
+    log_dir and of every file in library, so it only needs files to be stat'd.
+    """
+    logfiles = []
+    if os.path.isdir(log_dir):
+        logfiles = [(f, _StatKey(os.path.join(log_dir, f)))
+                    for f in sorted(os.listdir(log_dir))
+                    if f.startswith('messages_')]
+    return (_StatKey(state_file), tuple(logfiles), library.fingerprint)
+
+
+def LoadMobiMetadata(filename):
+    fp = open(filename, 'rb')
+    try:
+        return BookMetadata(mobibook.MobiBook(fp, lazy=True))
+    except mobibook.MobiException, e:
+        logger.warn('Could not read MobiBook %s: %s', filename, e)
+        return None
+    finally:
+        fp.close()
+
+
+def LoadSidecar(filename):
+    try:
+        sidecar = apnx_parser.ApnxFile(filename, use_mmap=True)
+        if not sidecar.HasPageNumbers():
+            logger.info('Sidecar %s has no page number data!', filename)
+            sidecar.close()
+            return None
+        sidecar.Load()
+        return sidecar
+    except apnx_parser.ApnxException, e:
+        logger.warn('Could not read page number sidecar %s: %s', filename, e)
+        return None
+
+
+class PageGenerator(object):
+    """Generates page numbers for books which have no .apnx sidecar.
+
+    Pages are either chars_per_page characters of text long, or lines_per_page
+    lines long. The generated sidecars are cached in a MetadataCache against
+    the book file.
+    """
+
+    def __init__(self, chars_per_page=None, lines_per_page=None):
+        if not lines_per_page:
+            chars_per_page = (chars_per_page or
+                              apnx_parser.DEFAULT_CHARS_PER_PAGE)
+        self.chars_per_page = chars_per_page
+        self.lines_per_page = lines_per_page
+
+    @property
+    def key(self):
+        return ('pages', self.chars_per_page, self.lines_per_page)
+
+    def Load(self, filename):
+        """Generate a sidecar for the book in filename, a loader for Get."""
+        fp = open(filename, 'rb')
+        try:
+            book = mobibook.MobiBook(fp, lazy=True)
+            positions = apnx_parser.GeneratePagePositions(
+                    (book.GetTextRecord(i) for i in xrange(book.txt_records)),
+                    self.chars_per_page, self.lines_per_page)
+            return apnx_parser.ApnxFile.FromPagePositions(
+                    positions, book.asin.encode('utf-8'))
+        except mobibook.MobiException, e:
+            logger.warn('Could not generate pages for %s: %s', filename, e)
+            return None
+        finally:
+            fp.close()
+
+    def Get(self, filename, cache):
+        return cache.Get(filename, self.Load, self.key)
+
+
+def _GetLoader(bookfile):
+    if bookfile.endswith(('.azw', '.mobi')):
+        return LoadMobiMetadata
+    elif bookfile.endswith('.apnx'):
+        return LoadSidecar
+    return None
+
+
+def GetBookMetadata(asin, library, cache, page_generator=None):
+    """Return (metadata, sidecar) for asin, either of which may be None.
+
+    If page_generator (a PageGenerator) is given, a sidecar is generated from
+    the book's text when there is no .apnx file for it.
+    """
     mobi = None
+    mobi_filename = None
     sidecar = None
-    for bookfile in sorted(os.listdir(book_dir)):
+    for bookfile, filename in library.GetFiles(asin):
         if mobi and sidecar:
             break
-        if asin not in bookfile:
-            continue
-        filename = os.path.join(book_dir, bookfile)
-        if bookfile.endswith(('.azw', '.mobi')):
-            try:
-                mobi = mobibook.MobiBook(open(filename, 'r'))
-            except mobibook.MobiException, e:
-                logger.warn('Could not read MobiBook %s for %s: %s', bookfile,
-                            asin, e)
-                mobi = None
-        elif bookfile.endswith('.apnx'):
-            try:
-                sidecar = apnx_parser.ApnxFile(filename)
-            except apnx_parser.ApnxException, e:
-                logger.warn('Could not read page number sidecar %s for %s: %s',
-                            bookfile, asin, e)
-                sidecar = None
-            if not sidecar.HasPageNumbers():
-                logger.info('Sidecar %s for %s has no page number data!',
-                        bookfile, asin)
-                sidecar = None
+        loader = _GetLoader(bookfile)
+        if loader == LoadMobiMetadata:
+            mobi = cache.Get(filename, loader)
+            mobi_filename = filename
+        elif loader == LoadSidecar:
+            sidecar = cache.Get(filename, loader)
 
+    if mobi and not sidecar and page_generator:
+        sidecar = page_generator.Get(mobi_filename, cache)
     return mobi, sidecar
 
 
-def PrintBooks(books, book_dir, only_book=None, verbose=False):
-    now = time.time()
-    rv = []
-    events = None
-    for book in books.values():
-        if only_book:
-            if book.asin != only_book:
+def ScanLibrary(library, cache, asins=None, threads=8):
+    """Load the metadata for many books concurrently.
+
+    Reading book files is mostly spent waiting on the (USB, MTP or network)
+    filesystem, so every file for the given asins (default: all the books in
+    library) is loaded into cache by a bounded pool of threads. Files which
+    can't be parsed are logged and skipped.
+
+    Returns a dict of asin => (mobi, sidecar), as from GetBookMetadata.
+    """
+    if asins is None:
+        asins = library.asins
+    tasks = []
+    for asin in asins:
+        for bookfile, filename in library.GetFiles(asin):
+            loader = _GetLoader(bookfile)
+            if loader:
+                tasks.append((filename, loader))
+
+    pool = ThreadPool(max(threads, 1))
+    try:
+        pool.map(lambda task: cache.Get(*task), tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return dict([(asin, GetBookMetadata(asin, library, cache))
+                 for asin in asins])
+
+
+def SearchLibrary(index, library, cache, queries, threads=1):
+    """Return the set of ASINs in library matching every one of queries.
+
+    queries is a list of (field, query) for LibraryIndex.Search. The index is
+    brought up to date with library first.
+    """
+    index.Update(library, cache, threads)
+    index.Store()
+    rv = set(library.asins)
+    for field, query in queries:
+        rv &= index.Search(field, query)
+    return rv
+
+
+# Text records shorter than this (such as an empty last record) are too
+# generic to tell books apart, so aren't compared between books.
+MIN_DUPLICATE_RECORD_LENGTH = 256
+# Records found in more books than this are boilerplate, not duplication.
+MAX_BOOKS_PER_RECORD = 8
+
+
+def HashBookText(filename):
+    """Hash the text of the book in filename.
+
+    Only the (decompressed) text records are hashed, so copies of a book with
+    different headers or EXTH metadata hash the same. Records are read one at
+    a time. Returns (filename, digest of the whole text, set of digests of the
+    records at least MIN_DUPLICATE_RECORD_LENGTH long), or None if the book
+    can't be read.
+    """
+    try:
+        fp = open(filename, 'rb')
+        try:
+            book = mobibook.MobiBook(fp, lazy=True)
+            digest = hashlib.sha1()
+            records = set()
+            for i in xrange(book.txt_records):
+                text = book.GetTextRecord(i)
+                digest.update(text)
+                if len(text) >= MIN_DUPLICATE_RECORD_LENGTH:
+                    records.add(hashlib.md5(text).digest()[:8])
+            return filename, digest.hexdigest(), records
+        finally:
+            fp.close()
+    except Exception, e:
+        # One bad book shouldn't stop the rest of the library being hashed.
+        logger.warn('Could not hash %s: %s', filename, e)
+        return None
+
+
+def FindDuplicates(library, similarity=0.9, processes=None):
+    """Find books in library with identical or near-identical text.
+
+    The text of each book is hashed by HashBookText in a pool of processes.
+    Two books are near-identical if at least similarity of the text records
+    of the shorter one are also in the other, so a sample is grouped with the
+    full book. Records shared by more than MAX_BOOKS_PER_RECORD books are
+    ignored, which also keeps the comparison linear in the size of the library.
+
+    Returns a list of groups of duplicate ASINs, each with the ASIN of the
+    longest book first.
+    """
+    asins = {}
+    for asin in library.asins:
+        for bookfile, filename in library.GetFiles(asin):
+            if bookfile.endswith(('.azw', '.mobi')):
+                asins[filename] = asin
+                break
+
+    pool = Pool(processes)
+    records = {}
+    digests = {}
+    parent = {}
+    try:
+        for result in pool.imap_unordered(HashBookText, sorted(asins)):
+            if not result:
                 continue
-            events = book.events
-        reads = book.reads
-        if not reads:
-            rv.append((0, book.asin, book))
-        else:
-            newest = max([t[2] is None and now or t[2] for t in reads])
-            rv.append((newest, book.asin, book))
+            filename, digest, hashes = result
+            asin = asins[filename]
+            records[asin] = hashes
+            # Identical texts are grouped straight away.
+            parent[asin] = digests.setdefault(digest, asin)
+    finally:
+        pool.close()
+        pool.join()
+
+    def _Find(asin):
+        while parent[asin] != asin:
+            parent[asin] = parent[parent[asin]]
+            asin = parent[asin]
+        return asin
+
+    # Count the records each pair of books has in common.
+    books_by_record = {}
+    for asin, hashes in records.iteritems():
+        for h in hashes:
+            books_by_record.setdefault(h, []).append(asin)
+    shared = {}
+    for asins_with_record in books_by_record.itervalues():
+        if len(asins_with_record) > MAX_BOOKS_PER_RECORD:
+            continue
+        asins_with_record.sort()
+        for i, a in enumerate(asins_with_record):
+            for b in asins_with_record[i + 1:]:
+                shared[(a, b)] = shared.get((a, b), 0) + 1
+    for (a, b), count in shared.iteritems():
+        shortest = min(len(records[a]), len(records[b]))
+        if count >= similarity * shortest:
+            parent[_Find(b)] = _Find(a)
+
+    groups = {}
+    for asin in records:
+        groups.setdefault(_Find(asin), []).append(asin)
+    return sorted([sorted(group, key=lambda a: (-len(records[a]), a))
+                   for group in groups.values() if len(group) > 1])
+
+
+def LoadAliases(filename):
+    """Load an ASIN alias map, as written by StoreAliases."""
+    fp = open(filename, 'rb')
+    try:
+        return json.load(fp)
+    finally:
+        fp.close()
+
+
+def StoreAliases(groups, filename):
+    """Write a map of ASIN => the first ASIN in its group to filename."""
+    aliases = {}
+    for group in groups:
+        for asin in group[1:]:
+            aliases[asin] = group[0]
+    tmp_filename = '%s.tmp' % filename
+    fp = open(tmp_filename, 'wb')
+    json.dump(aliases, fp, indent=1, sort_keys=True)
+    fp.close()
+    os.rename(tmp_filename, filename)
+
+
+def PrintLibrary(library, cache, threads, asins=None):
+    """Print the title and page count of the books in library.
+
+    If asins is given, only those books are printed.
+    """
+    books = ScanLibrary(library, cache, asins, threads=threads)
+    for asin, (metadata, sidecar) in sorted(books.iteritems()):
+        title = metadata and metadata.title or '?'
+        pages = ''
+        if sidecar:
+            pages = ' (%d pages)' % sidecar.GetEditionPageCount(0)
+        print '%s: %s%s' % (asin, title, pages)
+    print '%d books in %s' % (len(books), library.book_dir)
+
+
+def GetAsleepTimes(books, timeline):
+    """Find how long the device was asleep during each read of each book.
 
+    The open spans of every book are joined against the power state timeline
+    in a single sweep, then merged into the (chronologically ordered) reads
+    that contain them.
+
+    Returns a dict mapping asin => list of seconds asleep, one per read.
+    """
+    spans = []
+    for book in books.values():
+        for start, _, end, _ in book.spans:
+            if end is not None:
+                spans.append((start, end, book.asin))
+    asleep = {}
+    for span, durations in zip(spans, timeline.JoinSessions(spans)):
+        seconds = sum([durations.get(state, 0)
+                       for state in timeline.ASLEEP_STATES])
+        asleep.setdefault(span[2], []).append((span[0], seconds))
+
+    rv = {}
+    for asin, book in books.iteritems():
+        book_asleep = sorted(asleep.get(asin, []))
+        per_read = []
+        i = 0
+        for start, _, end, _, _ in book.reads:
+            while i < len(book_asleep) and book_asleep[i][0] < start:
+                i += 1
+            seconds = 0
+            while i < len(book_asleep) and (
+                    end is None or book_asleep[i][0] <= end):
+                seconds += book_asleep[i][1]
+                i += 1
+            per_read.append(seconds)
+        rv[asin] = per_read
+    return rv
+
+
+def _EventsFingerprint(book):
+    """Return a cheap fingerprint of the events of book.
+
+    Events are only ever appended, or the last one coalesced, so the count
+    and the last event identify the history.
+    """
+    if not book.events:
+        return (0, None)
+    return (len(book.events), tuple(book.events[-1]))
+
+
+def RenderBook(book, metadata, sidecar, detailed=False, book_asleep=None,
+               chapters=False):
+    """Render the report for a single book.
+
+    If detailed is True, every event of each read is listed. book_asleep is a
+    list of seconds asleep per read, as from GetAsleepTimes. If chapters is
+    True, the chapters each read started and ended in are shown.
+
+    Returns a tuple of (text, newest, in_progress, total reading time), where
+    newest is the latest finish of any read.
+    """
+    lines = []
+    reads = book.reads
+    ends = [t[2] for t in reads if t[2] is not None]
+    newest = ends and max(ends) or 0
+    in_progress = len(ends) < len(reads)
+    if metadata:
+        title = '%s: %s' % (book.asin, metadata.title)
+    else:
+        title = book.asin
+    lines.append('%s: Read % 2d times. Last Finished: %s' % (
+            title, len(reads),
+            in_progress and 'In Progress!' or time.ctime(newest)))
+    events = book.events
+    if detailed:
+        lines.append(' Length: %d' % book.length)
+        event_times = [event[0] for event in events]
+        if sidecar:
+            # Missing positions sort before every page, as in a bisect.
+            _, event_pages = sidecar.GetPageLabelsForPositions(
+                    [event[2] is None and -1 or event[2]
+                     for event in events])
+        else:
+            event_pages = ['?'] * len(events)
+    book_asleep = book_asleep or []
+    chapter_index = None
+    if chapters and metadata:
+        chapter_index = getattr(metadata, 'chapters', None)
     total_duration = 0
     eventpos = 0
-    for newest, asin, book in sorted(rv, reverse=True):
-        metadata, sidecar = GetBookMetadata(asin, book_dir)
-        if metadata:
-            title = '%s: %s' % (asin, metadata.title)
+    for i, (start, startpos, end, endpos, duration) in enumerate(reads):
+        if sidecar:
+            start_txt = 'p%s' % sidecar.GetPageLabelForPosition(startpos)
+            end_txt = 'p%s' % sidecar.GetPageLabelForPosition(endpos)
         else:
-            title = asin
-        reads = book.reads
-        print '%s: Read % 2d times. Last Finished: %s' % (
-                title, len(reads),
-                newest == now and 'In Progress!' or time.ctime(newest))
-        if only_book and verbose:
-            print ' Length: %d' % book.length
-        for start, startpos, end, endpos, duration in reads:
-            if sidecar:
-                start_txt = 'p%s' % sidecar.GetPageLabelForPosition(startpos)
-                end_txt = 'p%s' % sidecar.GetPageLabelForPosition(endpos)
-            else:
-                start_txt = '@%s' % startpos
-                end_txt = '@%s' % endpos
-            print ' - %s => %s. Reading time %s (%s => %s)' % (
-                    time.ctime(start),
-                    end is None and 'In Progress!' or time.ctime(end),
-                    PrintHMS(duration), start_txt, end_txt)
-            total_duration += duration
-            if only_book and verbose:
-                # Print all events.
-                for idx, event in enumerate(events[eventpos:]):
-                    ts, event_type, data = event
-                    if end and ts > end:
-                        eventpos += idx
-                        break
-                    if sidecar:
-                        page = sidecar.GetPageLabelForPosition(data)
-                    else:
-                        page = '?'
-                    print '   %s on page %s/%s @ %s' % (
-                            log_parser.KindleBook.EventToString(event_type),
-                            page, data, time.ctime(ts))
-        print ''
+            start_txt = '@%s' % startpos
+            end_txt = '@%s' % endpos
+        asleep_txt = ''
+        if i < len(book_asleep) and book_asleep[i]:
+            duration = max(duration - book_asleep[i], 0)
+            asleep_txt = ', %s asleep' % PrintHMS(book_asleep[i])
+        lines.append(' - %s => %s. Reading time %s (%s => %s%s)' % (
+                time.ctime(start),
+                end is None and 'In Progress!' or time.ctime(end),
+                PrintHMS(duration), start_txt, end_txt, asleep_txt))
+        if chapter_index:
+            lines[-1] += ' [%s => %s]' % (
+                    chapter_index.GetTitleForPosition(startpos) or '-',
+                    chapter_index.GetTitleForPosition(endpos) or '-')
+        total_duration += duration
+        if detailed:
+            # Print all events up to the end of this read.
+            eventend = len(events)
+            if end:
+                eventend = bisect_right(event_times, end, eventpos)
+            for idx in xrange(eventpos, eventend):
+                ts, event_type, data = events[idx]
+                lines.append('   %s on page %s/%s @ %s' % (
+                        log_parser.KindleBook.EventToString(event_type),
+                        event_pages[idx], data, time.ctime(ts)))
+            eventpos = eventend
+    lines.append('')
+    return '\n'.join(lines), newest, in_progress, total_duration
+
+
+def RenderBooks(books, library, cache, only_book=None, verbose=False,
+                timeline=None, threads=1, report_cache=None,
+                page_generator=None, chapters=False):
+    """Render a report of reading time for each book.
+
+    Titles and page numbers are read from the files in library, a BookLibrary,
+    via cache, a MetadataCache. If threads is more than 1, the metadata for all
+    the books in the report is prefetched concurrently.
+
+    If timeline (a log_parser.PowerStateTimeline) is given, time spent with
+    the device asleep is discounted from the reading time.
+
+    If report_cache (a ReportCache) is given, books whose events, files and
+    asleep times are unchanged since it was filled are not re-rendered.
+
+    If page_generator (a PageGenerator) is given, page numbers are generated
+    for books which have no .apnx sidecar. If chapters is True, reads are
+    annotated with the chapters they started and ended in.
+    """
+    now = time.time()
+    detailed = bool(only_book and verbose)
+    selected = [book for book in books.values()
+                if not only_book or book.asin == only_book]
 
+    asleep = {}
+    if timeline:
+        asleep = GetAsleepTimes(books, timeline)
+
+    entries = {}
+    keys = {}
+    for book in selected:
+        book_asleep = asleep.get(book.asin)
+        keys[book.asin] = (_EventsFingerprint(book),
+                           library.GetFingerprint(book.asin),
+                           book_asleep and tuple(book_asleep),
+                           page_generator and page_generator.key, chapters)
+        if report_cache:
+            entry = report_cache.GetBook(book.asin, detailed, bool(timeline),
+                                         keys[book.asin])
+            if entry:
+                entries[book.asin] = entry
+
+    missing = [book for book in selected if book.asin not in entries]
+    if threads > 1 and missing:
+        ScanLibrary(library, cache, [book.asin for book in missing], threads)
+    for book in missing:
+        metadata, sidecar = GetBookMetadata(book.asin, library, cache,
+                                            page_generator)
+        entries[book.asin] = RenderBook(book, metadata, sidecar, detailed,
+                                        asleep.get(book.asin), chapters)
+        if report_cache:
+            report_cache.SetBook(book.asin, detailed, bool(timeline),
+                                 keys[book.asin], entries[book.asin])
+
+    rv = []
+    for asin, (text, newest, in_progress, _) in entries.iteritems():
+        rv.append((in_progress and now or newest, asin, text))
+    lines = [t[2] for t in sorted(rv, reverse=True)]
     if not only_book:
-        print 'Read %d books in total. %s of reading time' % (
-                len(rv), PrintHMS(total_duration))
+        total_duration = sum([entry[3] for entry in entries.values()])
+        lines.append('Read %d books in total. %s of reading time' % (
+                len(rv), PrintHMS(total_duration)))
+    return '\n'.join(lines)
+
+
+def PrintBooks(books, library, cache, only_book=None, verbose=False,
+               timeline=None, threads=1, report_cache=None,
+               page_generator=None, chapters=False):
+    """Print a report of reading time for each book. See RenderBooks."""
+    report = RenderBooks(books, library, cache, only_book, verbose, timeline,
+                         threads, report_cache, page_generator, chapters)
+    if report:
+        print report
+
+
+def PrintRollups(rollups, days=None, weeks=None):
+    """Print daily or weekly totals from a log_parser.ReadingRollups.
+
+    Only the last days days, or weeks weeks (including today) are printed.
+    """
+    today = datetime.fromtimestamp(time.time(), rollups.timezone).date()
+    if days:
+        rows = [(d.isoformat(), r) for d, r in rollups.GetDays(
+                today - timedelta(days=days - 1))]
+    else:
+        since = (today - timedelta(weeks=weeks - 1)).isocalendar()[:2]
+        rows = [('%d-W%02d' % w, r) for w, r in rollups.GetWeeks(since)]
+
+    for period, rollup in rows:
+        states = sorted(rollup.states.iteritems(), key=lambda x: x[1],
+                        reverse=True)
+        print '%s: Read %s in %d sessions. %s' % (
+                period, PrintHMS(rollup.total_reading), rollup.total_sessions,
+                ', '.join(['%s %s' % (state, PrintHMS(duration))
+                           for state, duration in states]))
+        reading = sorted(rollup.reading.iteritems(), key=lambda x: x[1],
+                         reverse=True)
+        for asin, duration in reading:
+            print ' - %s: %s in %d sessions' % (
+                    asin, PrintHMS(duration), rollup.sessions.get(asin, 0))
+
+
+def GetReadingSpeeds(book, sidecar):
+    """Find how many pages were read in each span of time book was open.
+
+    The positions each span was opened and closed at are turned into ordinal
+    pages with a single lookup in the page positions of sidecar. Only pages
+    read forwards are counted, and spans without positions or which are still
+    open are skipped.
+
+    Returns (starts, durations, pages), numpy arrays if numpy is available or
+    lists otherwise, with one entry per span.
+    """
+    spans = [span for span in book.spans
+             if None not in (span[1], span[2], span[3])]
+    pages = sidecar.GetEditionPageIndex().GetPagesForPositions(
+            [span[1] for span in spans] + [span[3] for span in spans])
+    starts = [span[0] for span in spans]
+    ends = [span[2] for span in spans]
+    n = len(spans)
+    if numpy is None:
+        return (starts, [end - start for start, end in zip(starts, ends)],
+                [max(b - a, 0) for a, b in zip(pages[:n], pages[n:])])
+    starts = numpy.array(starts, dtype=numpy.int64)
+    durations = numpy.array(ends, dtype=numpy.int64) - starts
+    return starts, durations, numpy.maximum(pages[n:] - pages[:n], 0)
+
+
+def _PagesPerHour(pages, seconds):
+    if seconds <= 0:
+        return 0.0
+    return pages * 3600.0 / seconds
+
+
+def PrintSpeeds(books, library, cache, only_book=None, verbose=False,
+                threads=1, page_generator=None):
+    """Print reading speed in pages per hour for each book, and overall.
+
+    If only_book and verbose are given, the speed of each span of time the
+    book was open is printed too. Books without page numbers are skipped.
+    """
+    selected = [book for book in books.values()
+                if not only_book or book.asin == only_book]
+    if threads > 1:
+        ScanLibrary(library, cache, [book.asin for book in selected],
+                    threads)
+    rows = []
+    total_pages = 0
+    total_seconds = 0
+    for book in selected:
+        metadata, sidecar = GetBookMetadata(book.asin, library, cache,
+                                            page_generator)
+        if not sidecar:
+            continue
+        starts, durations, pages = GetReadingSpeeds(book, sidecar)
+        book_pages = int(sum(pages))
+        book_seconds = int(sum(durations))
+        if not book_seconds:
+            continue
+        total_pages += book_pages
+        total_seconds += book_seconds
+        lines = ['%s: %s: %d pages in %s. %.1f pages/hour' % (
+                book.asin, metadata and metadata.title or '?', book_pages,
+                PrintHMS(book_seconds),
+                _PagesPerHour(book_pages, book_seconds))]
+        if only_book and verbose:
+            for start, duration, read in zip(starts, durations, pages):
+                lines.append(' - %s: %d pages in %s. %.1f pages/hour' % (
+                        time.ctime(start), read, PrintHMS(duration),
+                        _PagesPerHour(read, duration)))
+        rows.append((_PagesPerHour(book_pages, book_seconds), book.asin,
+                     lines))
+    for _, _, lines in sorted(rows, reverse=True):
+        print '\n'.join(lines)
+    print 'Read %d pages in %s. %.1f pages/hour overall' % (
+            total_pages, PrintHMS(total_seconds),
+            _PagesPerHour(total_pages, total_seconds))
+
+
+def _GetUTCOffsets(starts, tz):
+    """Return the UTC offset in tz at each timestamp in starts.
+
+    Offsets are looked up once per day, and only looked up per timestamp on
+    days where the offset changes.
+    """
+    days = starts // 86400
+    unique_days, inverse = numpy.unique(days, return_inverse=True)
+    day_offsets = numpy.zeros(len(unique_days), dtype=numpy.int64)
+    changing = numpy.zeros(len(unique_days), dtype=bool)
+    for i, day in enumerate(unique_days):
+        first = datetime.fromtimestamp(int(day) * 86400, tz).utcoffset()
+        last = datetime.fromtimestamp(int(day) * 86400 + 86399,
+                                      tz).utcoffset()
+        day_offsets[i] = int(first.total_seconds())
+        changing[i] = first != last
+    offsets = day_offsets[inverse]
+    for i in numpy.flatnonzero(changing[inverse]):
+        offset = datetime.fromtimestamp(int(starts[i]), tz).utcoffset()
+        offsets[i] = int(offset.total_seconds())
+    return offsets
+
+
+def GetHeatmap(spans, tz):
+    """Distribute the time in spans over hour of day and day of week.
+
+    spans is a list of (start, end) tuples, which are shifted into local time
+    in tz (by the offset at their start). Partial hours at each end of a span
+    are added directly, while the full hours in between are counted with a
+    cumulative sum over hour boundaries, so no span is split in a loop.
+
+    Returns a 7x24 numpy array of seconds, indexed by [weekday][hour] with
+    Monday as weekday 0.
+    """
+    heatmap = numpy.zeros((7, 24))
+    if not spans:
+        return heatmap
+    starts = numpy.array([s[0] for s in spans], dtype=numpy.int64)
+    ends = numpy.array([s[1] for s in spans], dtype=numpy.int64)
+    offsets = _GetUTCOffsets(starts, tz)
+    starts += offsets
+    ends += offsets
+
+    first_hours = starts // 3600
+    last_hours = ends // 3600
+    base = first_hours.min()
+    num_hours = last_hours.max() - base + 2
+    same = first_hours == last_hours
+    # Seconds in the partial first and last hour of each span.
+    head = numpy.where(same, ends - starts, (first_hours + 1) * 3600 - starts)
+    tail = numpy.where(same, 0, ends - last_hours * 3600)
+    # +1/-1 at the first/last full hour covered, summed into a count of the
+    # spans covering each hour in full.
+    boundaries = numpy.zeros(num_hours + 1, dtype=numpy.int64)
+    numpy.add.at(boundaries, first_hours[~same] + 1 - base, 1)
+    numpy.add.at(boundaries, last_hours[~same] - base, -1)
+    seconds = (numpy.bincount(first_hours - base, weights=head,
+                              minlength=num_hours) +
+               numpy.bincount(last_hours - base, weights=tail,
+                              minlength=num_hours) +
+               numpy.cumsum(boundaries)[:num_hours] * 3600)
+
+    # The epoch started on a Thursday, i.e. 72 hours into the week.
+    hour_of_week = (numpy.arange(base, base + num_hours) + 72) % 168
+    heatmap += numpy.bincount(hour_of_week, weights=seconds,
+                              minlength=168).reshape(7, 24)
+    return heatmap
+
+
+def PrintHeatmap(books, tz):
+    """Print minutes of reading by hour of day and day of week."""
+    now = time.time()
+    spans = []
+    for book in books.values():
+        for start, _, end, _ in book.spans:
+            spans.append((start, end is None and now or end))
+    heatmap = GetHeatmap(spans, tz)
+
+    print 'Minutes read by hour (%s)' % tz
+    print '    %s' % ''.join(['% 5d' % h for h in xrange(24)])
+    for weekday, day in enumerate(['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat',
+                                   'Sun']):
+        print '%s %s' % (day, ''.join(['% 5d' % round(s / 60.0)
+                                       for s in heatmap[weekday]]))
 
 
 def ParseOptions(args):
@@ -150,14 +1058,84 @@ def ParseOptions(args):
                       dest='state_file',
                       default=os.path.expanduser('~/.kindle-utils.state'),
                       help='Path to file to load/store state from')
+    parser.add_option('-m', '--metadata_cache', action='store',
+                      dest='metadata_cache', default=None,
+                      help='Path to file to cache book metadata in '
+                      '(default: STATE_FILE.books)')
+    parser.add_option('-R', '--report_cache', action='store',
+                      dest='report_cache', default=None,
+                      help='Path to file to cache rendered reports in '
+                      '(default: STATE_FILE.report)')
     parser.add_option('-b', '--book_dir', action='store',
                       dest='book_dir',
                       default='/media/Kindle/documents',
                       help='Path to Kindle userstore documents directory')
+    parser.add_option('-r', '--recursive', action='store_true',
+                      dest='recursive',
+                      help='also look for books in subdirectories of book_dir')
+    parser.add_option('-S', '--scan', action='store_true', dest='scan',
+                      help='scan and list all the books in book_dir')
+    parser.add_option('-j', '--threads', action='store', type='int',
+                      dest='threads', default=None,
+                      help='Number of threads to read book files with '
+                      '(default: 1), or of processes to hash them with for '
+                      '--find_duplicates (default: one per CPU)')
     parser.add_option('-B', '--book', action='store',
                       dest='book',
                       default=None,
                       help='ASIN of specific book to view')
+    parser.add_option('-I', '--index', action='store',
+                      dest='index_file', default=None,
+                      help='File to store the library index in (default: '
+                      'state_file.index)')
+    parser.add_option('--author', action='store', dest='author',
+                      default=None,
+                      help='only report on books by this author')
+    parser.add_option('--subject', action='store', dest='subject',
+                      default=None,
+                      help='only report on books with this subject')
+    parser.add_option('-A', '--aliases', action='store', dest='aliases',
+                      default=None,
+                      help='File mapping the ASINs of duplicate books to the '
+                      'ASIN to report them under')
+    parser.add_option('--find_duplicates', action='store_true',
+                      dest='find_duplicates',
+                      help='find duplicate books in book_dir, and write them '
+                      'to the --aliases file')
+    parser.add_option('--similarity', action='store', type='float',
+                      dest='similarity', default=0.9,
+                      help='Fraction of text two books must share to be '
+                      'duplicates (default: %default)')
+    parser.add_option('-g', '--generate_pages', action='store_true',
+                      dest='generate_pages',
+                      help='generate page numbers for books with no .apnx')
+    parser.add_option('--chars_per_page', action='store', type='int',
+                      dest='chars_per_page', default=None,
+                      help='Characters per generated page (default: %d)' %
+                      apnx_parser.DEFAULT_CHARS_PER_PAGE)
+    parser.add_option('--lines_per_page', action='store', type='int',
+                      dest='lines_per_page', default=None,
+                      help='Generate pages of this many %d character lines, '
+                      'rather than by characters' %
+                      apnx_parser.DEFAULT_LINE_LENGTH)
+    parser.add_option('-C', '--chapters', action='store_true',
+                      dest='chapters',
+                      help='show the chapters each read started and ended in')
+    parser.add_option('-a', '--awake', action='store_true', dest='awake',
+                      help='discount reading time while the device was asleep')
+    parser.add_option('-d', '--days', action='store', type='int',
+                      dest='days', default=None,
+                      help='print daily totals for the last DAYS days')
+    parser.add_option('-w', '--weeks', action='store', type='int',
+                      dest='weeks', default=None,
+                      help='print weekly totals for the last WEEKS weeks')
+    parser.add_option('-P', '--speed', action='store_true', dest='speed',
+                      help='print reading speed in pages per hour')
+    parser.add_option('-H', '--heatmap', action='store_true', dest='heatmap',
+                      help='print reading time by hour and day of week')
+    parser.add_option('-z', '--timezone', action='store', dest='timezone',
+                      default=log_parser.KindleLogState.DEFAULT_TZ.zone,
+                      help='Timezone to use for the heatmap')
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose',
                       help='enable verbose logging')
 
@@ -171,18 +1149,111 @@ def main():
 
     logging.basicConfig()
     options, args = ParseOptions(sys.argv)
+    log_parser.SetVerbosity(options.verbose)
+    threads = options.threads or 1
+    library = BookLibrary(options.book_dir, options.recursive)
+    cache = MetadataCache(options.metadata_cache or
+                          '%s.books' % options.state_file)
+    queries = [(field, query) for field, query in (
+            ('creator', options.author), ('subject', options.subject))
+               if query]
+    matches = None
+    if queries:
+        index = LibraryIndex(options.index_file or
+                             '%s.index' % options.state_file)
+        matches = SearchLibrary(index, library, cache, queries,
+                                threads)
+        cache.Store()
+    if options.scan:
+        PrintLibrary(library, cache, threads, matches)
+        cache.Store()
+        return
+    if options.find_duplicates:
+        groups = FindDuplicates(library, options.similarity,
+                                options.threads)
+        for group in groups:
+            print '%s: %s' % (group[0], ', '.join(group[1:]))
+        print '%d duplicated books in %s' % (len(groups), library.book_dir)
+        if options.aliases:
+            StoreAliases(groups, options.aliases)
+        return
+    aliases = None
+    if options.aliases and os.path.exists(options.aliases):
+        aliases = LoadAliases(options.aliases)
+        if matches is not None:
+            matches = set([aliases.get(asin, asin) for asin in matches])
     if len(args) < 2:
         logging.fatal('You must specify a directory to read from!')
         sys.exit(1)
-    log_parser.SetVerbosity(options.verbose)
+    page_generator = None
+    if options.generate_pages:
+        page_generator = PageGenerator(options.chars_per_page,
+                                       options.lines_per_page)
+    report_cache = None
+    if not (options.days or options.weeks or options.heatmap or
+            options.speed):
+        # Reports only depend on the history, logs, library and options, so
+        # an unchanged run can be answered from the cache straight away.
+        report_cache = ReportCache(options.report_cache or
+                                   '%s.report' % options.state_file)
+        report_options = (os.path.abspath(args[1]),
+                          os.path.abspath(options.book_dir),
+                          bool(options.recursive), options.book,
+                          bool(options.verbose), bool(options.awake),
+                          page_generator and page_generator.key,
+                          bool(options.chapters), tuple(queries),
+                          aliases is not None and (
+                                  os.path.abspath(options.aliases),
+                                  _StatKey(options.aliases)))
+        report = report_cache.GetReport(
+                report_options,
+                GetReportKey(options.state_file, args[1], library))
+        if report is not None:
+            if report:
+                print report
+            return
     logs = log_parser.LoadHistory(options.state_file)
     if not logs:
         logs = log_parser.KindleLogs()
     logs.ProcessDirectory(args[1])
     log_parser.StoreHistory(logs, options.state_file)
-    books = logs.books
+    if options.days or options.weeks:
+        PrintRollups(logs.GetRollups(), options.days, options.weeks)
+        return
+    books = logs.GetBooks(aliases)
+    if matches is not None:
+        books = dict([(asin, book) for asin, book in books.iteritems()
+                      if asin in matches])
+    if options.heatmap:
+        if not numpy:
+            logging.fatal('The heatmap requires numpy to be installed!')
+            sys.exit(1)
+        try:
+            tz = pytz.timezone(options.timezone)
+        except pytz.UnknownTimeZoneError:
+            logging.fatal('Unknown timezone: %s', options.timezone)
+            sys.exit(1)
+        PrintHeatmap(books, tz)
+        return
+    if options.speed:
+        PrintSpeeds(books, library, cache, options.book, options.verbose,
+                    threads, page_generator)
+        cache.Store()
+        return
+    timeline = None
+    if options.awake:
+        timeline = logs.GetTimeline()
 
-    PrintBooks(books, options.book_dir, options.book, options.verbose)
+    report = RenderBooks(books, library, cache, options.book, options.verbose,
+                         timeline, threads, report_cache,
+                         page_generator, options.chapters)
+    if report:
+        print report
+    cache.Store()
+    report_cache.SetReport(report_options,
+                           GetReportKey(options.state_file, args[1], library),
+                           report)
+    report_cache.Store()
 
 
 if __name__ == '__main__':
@@ -3,7 +3,9 @@
 # This file is released under the GPLv2 license.
 #     Copyright (C) 2012 Matt Brown <matt@mattb.net.nz>
 
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta, tzinfo
+import calendar
 import code
 import cPickle as pickle
 import logging
@@ -222,6 +224,87 @@ class KindleBook(object):
                          FormatTime(events[0][0]))
         self.events.extend(events)
 
+    @classmethod
+    def Merge(cls, asin, books):
+        """Return a new KindleBook with the events of several copies of a book.
+
+        Putting one copy down and picking up (or opening) another at the same
+        time is a switch between copies, which keeps the book in hand. Any
+        other pick up starts afresh, as it does for a single book, so a copy
+        that was never put down (e.g. due to a gap in the logs) doesn't stay
+        in hand. A copy opened while no copy is in hand is picked up.
+        """
+        merged = cls(asin, None)
+        merged.length = max([book.length for book in books])
+        # At the same time, put downs and closes come before pick ups and
+        # opens, so that switches between copies can be spotted.
+        order = {cls.PUT_DOWN: 0, cls.CLOSE: 1, cls.PICK_UP: 2, cls.OPEN: 3}
+        events = sorted([(event[0], order[event[1]], i, j, event[1], event[2])
+                         for i, book in enumerate(books)
+                         for j, event in enumerate(book.events)])
+        in_hand = set()
+        # [ts, copy, position] of a put down which may be a switch.
+        pending = None
+        for ts, _, i, _, etype, position in events:
+            is_open = merged.events and merged.events[-1][1] in (
+                    cls.PICK_UP, cls.OPEN)
+            if pending and pending[0] != ts:
+                merged.events.append([pending[0], cls.PUT_DOWN, pending[2]])
+                pending = None
+            if etype == cls.PUT_DOWN:
+                in_hand.discard(i)
+                if in_hand:
+                    merged.events.append([ts, cls.CLOSE, position])
+                else:
+                    pending = [ts, i, position]
+                continue
+            if etype == cls.CLOSE:
+                if pending and pending[1] == i:
+                    # Closed as the copy was put down.
+                    pending[2] = position or pending[2]
+                else:
+                    merged.events.append([ts, etype, position])
+                continue
+            if pending and pending[1] != i:
+                # Switching copies, so the book is still in hand, and still
+                # open if it was open before.
+                pending = None
+                in_hand = set([i])
+                if is_open:
+                    continue
+                etype = cls.OPEN
+            else:
+                if pending:
+                    merged.events.append([pending[0], cls.PUT_DOWN,
+                                          pending[2]])
+                    pending = None
+                if etype == cls.PICK_UP or not in_hand:
+                    etype = cls.PICK_UP
+                    in_hand = set([i])
+                else:
+                    in_hand.add(i)
+            merged.events.append([ts, etype, position])
+        if pending:
+            merged.events.append([pending[0], cls.PUT_DOWN, pending[2]])
+        cls._CheckMerge(merged, books)
+        return merged
+
+    @classmethod
+    def _CheckMerge(cls, merged, books):
+        """Warn if merging copies that never overlapped lost reading time."""
+        reads = sorted([(read[0], read[2], i)
+                        for i, book in enumerate(books)
+                        for read in book.reads])
+        for (_, end, i), (start, _, j) in zip(reads, reads[1:]):
+            if i != j and (end is None or start < end):
+                return  # The copies overlap.
+        copies_time = sum([read[4] for book in books for read in book.reads])
+        merged_time = sum([read[4] for read in merged.reads])
+        if merged_time < copies_time:
+            logger.warn('%s: Merged copies have %ds of reading time, but the '
+                        'copies have %ds!', merged.asin, merged_time,
+                        copies_time)
+
     @classmethod
     def EventToString(cls, event_type):
         if event_type == cls.PICK_UP:
@@ -313,6 +396,34 @@ class KindleBook(object):
             _AppendRead((first, firstpos, None, latestpos, read_time))
         return rv
 
+    @property
+    def spans(self):
+        """Return a list of the spans of time the book was open.
+
+        Each entry in the list is a tuple of the form:
+        (open_ts, open_loc, close_ts, close_loc)
+
+        close_ts and close_loc are None if the book is still open.
+        """
+        rv = []
+        start = None
+        startpos = None
+        latestpos = None
+        for ts, etype, data in sorted(self.events):
+            if etype in (self.PICK_UP, self.OPEN):
+                start = ts
+                startpos = data
+                latestpos = data
+            elif etype in (self.CLOSE, self.PUT_DOWN):
+                if data:
+                    latestpos = data
+                if start is not None:
+                    rv.append((start, startpos, ts, latestpos))
+                start = None
+        if start is not None:
+            rv.append((start, startpos, None, None))
+        return rv
+
 
 
 class KindleLog(object):
@@ -806,11 +917,368 @@ class KindleLog(object):
         sys.exit(1)
 
 
+class PowerStateTimeline(object):
+    """Queryable index over the power state transitions of many logfiles.
+
+    The transitions from each logfile are merged into a single sorted array of
+    timestamps, where the device is in _states[i] from _times[i] until
+    _times[i+1]. For every state a prefix sum of the time spent in it up to
+    each transition is kept, so both the state at a given time and the time
+    spent in each state over a range can be found with a bisect.
+
+    The timeline starts at the first recorded transition, and ends at the last
+    one (the end of the last logfile).
+    """
+
+    # States in which the device is asleep, and can't be being read.
+    ASLEEP_STATES = ('SCREEN_SAVER', 'READY_TO_SUSPEND', 'SUSPENDED')
+
+    def __init__(self, logfiles):
+        self._times = []
+        self._states = []
+        for logfile in sorted(logfiles):
+            for ts, state in logfile.states:
+                if self._times and ts <= self._times[-1]:
+                    if ts < self._times[-1]:
+                        logger.debug('Power state transition to %s @ %s is '
+                                     'out of order. Ignoring!', state,
+                                     FormatTime(ts))
+                        continue
+                    # Zero length state, replace it.
+                    self._times.pop()
+                    self._states.pop()
+                self._times.append(ts)
+                self._states.append(state)
+
+        # _cumulative[state][i] is the time spent in state before _times[i].
+        self._cumulative = dict((s, [0]) for s in set(self._states))
+        for i in xrange(1, len(self._times)):
+            duration = self._times[i] - self._times[i-1]
+            for state, cumulative in self._cumulative.iteritems():
+                if state == self._states[i-1]:
+                    cumulative.append(cumulative[-1] + duration)
+                else:
+                    cumulative.append(cumulative[-1])
+
+    @property
+    def start(self):
+        return self._times and self._times[0] or None
+
+    @property
+    def end(self):
+        return self._times and self._times[-1] or None
+
+    @property
+    def states(self):
+        return self._cumulative.keys()
+
+    def _Index(self, ts):
+        """Index of the transition in effect at ts, or -1 if before start."""
+        return bisect_right(self._times, ts) - 1
+
+    def GetStateAt(self, ts):
+        """Return the power state the device was in at ts.
+
+        Returns None if ts is outside the timeline.
+        """
+        i = self._Index(ts)
+        if i < 0 or ts >= self._times[-1]:
+            return None
+        return self._states[i]
+
+    def _TimeInStateBefore(self, state, ts):
+        """Total time spent in state from the start of the timeline to ts."""
+        i = self._Index(ts)
+        if i < 0:
+            return 0
+        cumulative = self._cumulative[state]
+        if i == len(self._times) - 1:
+            return cumulative[i]
+        rv = cumulative[i]
+        if self._states[i] == state:
+            rv += ts - self._times[i]
+        return rv
+
+    def GetDuration(self, state, start, end):
+        """Return the time spent in state over [start, end)."""
+        if state not in self._cumulative or end <= start:
+            return 0
+        return (self._TimeInStateBefore(state, end) -
+                self._TimeInStateBefore(state, start))
+
+    def GetDurations(self, start, end):
+        """Return a dict of the time spent in each state over [start, end).
+
+        States which were not entered during the range are omitted.
+        """
+        rv = {}
+        for state in self._cumulative:
+            duration = self.GetDuration(state, start, end)
+            if duration:
+                rv[state] = duration
+        return rv
+
+    def GetTransitions(self):
+        """Return the (ts, state) transitions making up the timeline."""
+        return zip(self._times, self._states)
+
+    def JoinSessions(self, sessions):
+        """Split each session's duration by the power states it spanned.
+
+        sessions is a list of tuples starting with (start, end, ...). Sessions
+        are swept in start order alongside the sorted transitions, so the
+        join is linear in the number of sessions plus transitions (plus any
+        overlap between sessions).
+
+        Returns a list, in the same order as sessions, of dicts mapping each
+        state to the time spent in it during the session. Time outside the
+        timeline is not accounted for.
+        """
+        rv = [None] * len(sessions)
+        order = sorted(xrange(len(sessions)), key=lambda i: sessions[i][:2])
+        last = len(self._times) - 1
+        j = 0
+        for i in order:
+            start, end = sessions[i][:2]
+            durations = {}
+            while j < last and self._times[j+1] <= start:
+                j += 1
+            k = j
+            while k < last and self._times[k] < end:
+                duration = (min(end, self._times[k+1]) -
+                            max(start, self._times[k]))
+                if duration > 0:
+                    state = self._states[k]
+                    durations[state] = durations.get(state, 0) + duration
+                k += 1
+            rv[i] = durations
+        return rv
+
+
+class IntervalIndex(object):
+    """Static index answering which intervals cover a point or range.
+
+    The start and end of every interval are collected into a sorted array of
+    boundaries, splitting the timeline into elementary segments. A single
+    sweep records which intervals cover each segment, so a point query is a
+    bisect, and a range query a bisect plus a walk over the segments in range.
+    """
+
+    def __init__(self, intervals):
+        """intervals is a list of (start, end, value) tuples."""
+        intervals = sorted([i for i in intervals if i[1] > i[0]],
+                           key=lambda i: i[:2])
+        self._values = [i[2] for i in intervals]
+        points = []
+        for idx, (start, end, _) in enumerate(intervals):
+            points.append((start, 1, idx))
+            points.append((end, -1, idx))
+        points.sort()
+
+        self._bounds = []
+        self._covering = []
+        active = set()
+        for ts, change, idx in points:
+            if change > 0:
+                active.add(idx)
+            else:
+                active.discard(idx)
+            if self._bounds and self._bounds[-1] == ts:
+                self._covering[-1] = active
+            else:
+                self._bounds.append(ts)
+                self._covering.append(active)
+            active = set(active)
+        self._covering = [tuple(sorted(c)) for c in self._covering]
+
+    def __len__(self):
+        return len(self._values)
+
+    def At(self, ts):
+        """Return the values of all intervals covering ts."""
+        i = bisect_right(self._bounds, ts) - 1
+        if i < 0:
+            return []
+        return [self._values[idx] for idx in self._covering[i]]
+
+    def Between(self, start, end):
+        """Return the values of all intervals overlapping [start, end)."""
+        first = max(bisect_right(self._bounds, start) - 1, 0)
+        last = bisect_left(self._bounds, end)
+        found = set()
+        for covering in self._covering[first:last]:
+            found.update(covering)
+        return [self._values[idx] for idx in sorted(found)]
+
+
+class ReadingIndex(object):
+    """Index of reading activity across all books.
+
+    Answers which books were being read (according to KindleBook.reads), or
+    were open (according to KindleBook.spans), at a given time or during a
+    range of time. Reads and spans still in progress are treated as ending at
+    now.
+    """
+
+    def __init__(self, books, now=None):
+        if now is None:
+            now = time.time()
+        reads = []
+        spans = []
+        for book in books.values():
+            for read in book.reads:
+                end = read[2] is None and now or read[2]
+                reads.append((read[0], end, (book.asin,) + read))
+            for span in book.spans:
+                end = span[2] is None and now or span[2]
+                spans.append((span[0], end, (book.asin,) + span))
+        self._reads = IntervalIndex(reads)
+        self._spans = IntervalIndex(spans)
+
+    def GetReadsAt(self, ts):
+        """Return (asin,) + read tuples for all reads in progress at ts."""
+        return self._reads.At(ts)
+
+    def GetReadsBetween(self, start, end):
+        """Return (asin,) + read tuples for all reads during [start, end)."""
+        return self._reads.Between(start, end)
+
+    def GetSpansAt(self, ts):
+        """Return (asin,) + span tuples for all books open at ts."""
+        return self._spans.At(ts)
+
+    def GetSpansBetween(self, start, end):
+        """Return (asin,) + span tuples for books open during [start, end)."""
+        return self._spans.Between(start, end)
+
+    def GetBooksAt(self, ts):
+        """Return the ASINs of the books open at ts."""
+        return sorted(set(s[0] for s in self._spans.At(ts)))
+
+
+def SplitByDay(tz, start, end):
+    """Split [start, end) at local midnights in tz.
+
+    Returns a list of (date, seconds) tuples.
+    """
+    rv = []
+    while start < end:
+        day = datetime.fromtimestamp(start, tz).date()
+        midnight = tz.localize(datetime.combine(day + timedelta(days=1),
+                                                datetime.min.time()))
+        boundary = calendar.timegm(midnight.utctimetuple())
+        chunk_end = min(end, max(boundary, start + 1))
+        rv.append((day, chunk_end - start))
+        start = chunk_end
+    return rv
+
+
+class Rollup(object):
+    """Reading and power state totals for a single day or week."""
+
+    def __init__(self):
+        # asin => seconds the book was open.
+        self.reading = {}
+        # asin => number of times the book was opened.
+        self.sessions = {}
+        # power state => seconds in that state.
+        self.states = {}
+
+    @property
+    def total_reading(self):
+        return sum(self.reading.values())
+
+    @property
+    def total_sessions(self):
+        return sum(self.sessions.values())
+
+
+class ReadingRollups(object):
+    """Daily and ISO weekly rollups of reading and power state time.
+
+    Logfiles are added in order as they are processed, keeping the open book
+    spans and current power state across files, so the rollups never need to
+    be rebuilt from the full history. Days are in the timezone of the logfile
+    being added, and time spanning midnight is split between the two days.
+    """
+
+    def __init__(self):
+        # date => Rollup.
+        self.days = {}
+        # (iso year, iso week) => Rollup.
+        self.weeks = {}
+        self.timezone = KindleLogState.DEFAULT_TZ
+        # The (ts, state) power state at the end of the last file added.
+        self._power_state = (None, None)
+        # asin => ts of a book left open at the end of the last file added.
+        self._open = {}
+
+    def _Rollups(self, day):
+        week = day.isocalendar()[:2]
+        if day not in self.days:
+            self.days[day] = Rollup()
+        if week not in self.weeks:
+            self.weeks[week] = Rollup()
+        return self.days[day], self.weeks[week]
+
+    def _AddState(self, state, start, end):
+        for day, seconds in SplitByDay(self.timezone, start, end):
+            for rollup in self._Rollups(day):
+                rollup.states.setdefault(state, 0)
+                rollup.states[state] += seconds
+
+    def _AddSpan(self, asin, start, end):
+        first = True
+        for day, seconds in SplitByDay(self.timezone, start, end):
+            for rollup in self._Rollups(day):
+                rollup.reading.setdefault(asin, 0)
+                rollup.reading[asin] += seconds
+                if first:
+                    rollup.sessions.setdefault(asin, 0)
+                    rollup.sessions[asin] += 1
+            first = False
+
+    def AddLog(self, log):
+        """Add the power states and book spans from a parsed KindleLog."""
+        self.timezone = log.state.timezone
+        last_ts, last_state = self._power_state
+        for ts, state in log.states:
+            if last_ts is not None and ts > last_ts:
+                self._AddState(last_state, last_ts, ts)
+            if last_ts is None or ts >= last_ts:
+                last_ts, last_state = ts, state
+        self._power_state = (last_ts, last_state)
+
+        # Follows the same open/close logic as KindleBook.spans.
+        for asin, book in log.books.iteritems():
+            start = self._open.pop(asin, None)
+            for ts, etype, _ in sorted(book.events):
+                if etype in (KindleBook.PICK_UP, KindleBook.OPEN):
+                    start = ts
+                elif etype in (KindleBook.CLOSE, KindleBook.PUT_DOWN):
+                    if start is not None:
+                        self._AddSpan(asin, start, ts)
+                    start = None
+            if start is not None:
+                self._open[asin] = start
+
+    def GetDays(self, since=None):
+        """Return sorted (date, Rollup) tuples, optionally from since on."""
+        return sorted([(d, r) for d, r in self.days.iteritems()
+                       if since is None or d >= since])
+
+    def GetWeeks(self, since=None):
+        """Return sorted ((year, week), Rollup) tuples from since on."""
+        return sorted([(w, r) for w, r in self.weeks.iteritems()
+                       if since is None or w >= since])
+
+
 class KindleLogs(object):
 
     def __init__(self):
         self.files = []
         self.state = None
+        self.rollups = ReadingRollups()
 
     def ProcessDirectory(self, directory):
         """Processes a directory of ordered Kindle logfiles.
@@ -819,7 +1287,9 @@ class KindleLogs(object):
         accordingly (skipping duplicates, ignoring partial logfiles).
         """
         logger.info('Processing logs from %s', directory)
+        self.GetRollups()
         last_seq = ('', '')
+        rebuild_rollups = False
         for logfile in sorted(os.listdir(directory)):
             if not logfile.startswith('messages_'):
                 continue
@@ -834,10 +1304,13 @@ class KindleLogs(object):
                 logger.info('Ignoring %s in favour of %s',
                             old.state.last_filename, logfile)
                 self.state = self.files[-1].state
+                # The ignored file is already in the rollups.
+                rebuild_rollups = True
             try:
                 log = KindleLog(os.path.join(directory, logfile), self.state)
                 self.files.append(log)
                 self.state = log.state  # Triggers parsing.
+                self._UpdateRollups(log)
                 last_seq = (seq, datestr)
                 logger.info('Parsed %s. %s -> %s.', log, FormatTime(log.start),
                             FormatTime(log.end))
@@ -846,6 +1319,8 @@ class KindleLogs(object):
                 logger.error('Could not parse %s! %s', logfile, e)
                 continue
         self.files.sort()
+        if rebuild_rollups:
+            self.RebuildRollups()
         logger.info('Found %d logs. %s => %s', len(self.files),
                     FormatTime(self.files[0].start),
                     FormatTime(self.files[-1].end))
@@ -857,12 +1332,14 @@ class KindleLogs(object):
         attempt to interpret filenames and apply any special logic.
         """
         logger.info('Processing specified logfiles: %s', ', '.join(files))
+        self.GetRollups()
         last_seq = ('', '')
         for logfile in files:
             try:
                 log = KindleLog(logfile, self.state)
                 self.files.append(log)
                 self.state = log.state  # Triggers parsing.
+                self._UpdateRollups(log)
                 logger.info('Parsed %s. %s -> %s.', log, FormatTime(log.start),
                             FormatTime(log.end))
                 logger.debug('State: %s', self.state)
@@ -874,6 +1351,22 @@ class KindleLogs(object):
                     FormatTime(self.files[0].start),
                     FormatTime(self.files[-1].end))
 
+    def _UpdateRollups(self, log):
+        self.GetRollups().AddLog(log)
+
+    def RebuildRollups(self):
+        """Recalculate the daily and weekly rollups from all logfiles."""
+        self.rollups = ReadingRollups()
+        for logfile in sorted(self.files):
+            self.rollups.AddLog(logfile)
+
+    def GetRollups(self):
+        """Return the ReadingRollups for all processed logfiles."""
+        if getattr(self, 'rollups', None) is None:
+            # History stored before rollups existed.
+            self.RebuildRollups()
+        return self.rollups
+
     def GetStates(self):
         states = {}
         for logfile in self.files:
@@ -889,8 +1382,25 @@ class KindleLogs(object):
         for state, duration in t:
             print '%s: %d' % (state, duration)
 
+    def GetTimeline(self):
+        """Return a PowerStateTimeline covering all processed logfiles."""
+        return PowerStateTimeline(self.files)
+
+    def GetReadingIndex(self, now=None):
+        """Return a ReadingIndex covering all books read."""
+        return ReadingIndex(self.books, now)
+
     @property
     def books(self):
+        return self.GetBooks()
+
+    def GetBooks(self, aliases=None):
+        """Return a dict of asin => KindleBook for every book read.
+
+        aliases is an optional dict mapping the ASINs of duplicate books to
+        the ASIN they are a copy of. The events of all the copies of a book
+        are merged into a single KindleBook under that ASIN.
+        """
         books = {}
         for logfile in self.files:
             for book in logfile.books.values():
@@ -898,6 +1408,14 @@ class KindleLogs(object):
                     books[book.asin].UpdateEvents(book.events)
                 else:
                     books[book.asin] = book
+        copies = {}
+        for asin in (aliases and books.keys() or []):
+            target = aliases.get(asin, asin)
+            if target != asin:
+                copies.setdefault(target, [books.get(target)]).append(
+                        books.pop(asin))
+        for asin, merge in copies.iteritems():
+            books[asin] = KindleBook.Merge(asin, [b for b in merge if b])
         # Remove any books with zero reads.
         for asin in books.keys():
             if len(books[asin].reads) <= 0:
@@ -3,19 +3,26 @@
 #
 # Modified from mobidedrm v0.41.
 #
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
 import logging
+import mmap
+import os
 import struct
 import sys
 
 if sys.hexversion < 0x02070000:
     sys.exit("Python 2.7 or newer is required to run this program.")
 
+import batch
+
 CRYPTO_NONE = 0
 CRYPTO_MOBIPOCKET = 1
 CRYPTO_AMAZON = 2
 
-COMPRESSION_NONE = 0
-COMPRESSION_PALMDOC = 1
+COMPRESSION_NONE = 1
+COMPRESSION_PALMDOC = 2
 COMPRESSION_HUFFDIC = 17480
 
 # Map EXTH record types to names.
@@ -58,6 +65,12 @@ CODEPAGE_MAP = {
 }
 DEFAULT_ENCODING = 'windows-1252'
 
+# Precompiled structs for the fixed layout header fields.
+UINT16 = struct.Struct('>H')
+UINT32 = struct.Struct('>L')
+UINT64 = struct.Struct('>Q')
+EXTH_RECORD = struct.Struct('>LL')
+
 logger = logging.getLogger().getChild('mobibook')
 
 
@@ -65,13 +78,471 @@ class MobiException(Exception):
     pass
 
 
+class LRUCache(object):
+    """A dict-like cache holding up to size of the most recently used items."""
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+
+    def Get(self, key):
+        """Return the item for key (marking it most recently used), or None."""
+        value = self._items.pop(key, None)
+        if value is not None:
+            self._items[key] = value
+        return value
+
+    def Set(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def UncompressPalmDOC(data):
+    """Decompress a PalmDOC (LZ77) compressed text record."""
+    src = bytearray(data)
+    out = bytearray()
+    i = 0
+    end = len(src)
+    while i < end:
+        c = src[i]
+        i += 1
+        if 1 <= c <= 8:
+            # Literal run of the next c bytes.
+            out += src[i:i+c]
+            i += c
+        elif c < 0x80:
+            out.append(c)
+        elif c >= 0xC0:
+            # Space followed by a character.
+            out.append(0x20)
+            out.append(c ^ 0x80)
+        else:
+            # Copy length bytes from distance bytes back in the output.
+            if i >= end:
+                raise MobiException('Truncated PalmDOC record')
+            c = (c << 8) | src[i]
+            i += 1
+            distance = (c >> 3) & 0x7FF
+            length = (c & 0x7) + 3
+            if not distance or distance > len(out):
+                raise MobiException('Invalid PalmDOC back reference')
+            start = len(out) - distance
+            if distance >= length:
+                out += out[start:start+length]
+            else:
+                # The copy overlaps itself, repeating the last distance bytes.
+                chunk = out[start:]
+                out += (chunk * (length // distance + 1))[:length]
+    return str(out)
+
+
+class HuffcdicReader(object):
+    """Decompresses HUFF/CDIC (Huffman dictionary) compressed text records.
+
+    The HUFF record holds the tables used to find the length of each code,
+    and the CDIC records hold the dictionary of phrases that codes map to. The
+    tables are built once, and compressed phrases are expanded (and
+    remembered) the first time they are used.
+    """
+
+    def __init__(self, huff, cdics):
+        self._LoadHuff(huff)
+        self._dictionary = []
+        for cdic in cdics:
+            self._LoadCdic(cdic)
+
+    def _LoadHuff(self, huff):
+        if huff[0:8] != 'HUFF\x00\x00\x00\x18':
+            raise MobiException('Invalid HUFF record header')
+        off1, off2 = struct.unpack_from('>LL', huff, 8)
+        # Indexed by the first byte of a code: (code length, whether that
+        # length is final, maximum code), with codes aligned to 32 bits.
+        self._dict1 = []
+        for v in struct.unpack_from('>256L', huff, off1):
+            codelen, term, maxcode = v & 0x1F, v & 0x80, v >> 8
+            if not codelen or (codelen <= 8 and not term):
+                raise MobiException('Invalid HUFF code length table')
+            self._dict1.append(
+                    (codelen, term, ((maxcode + 1) << (32 - codelen)) - 1))
+        # The minimum and maximum codes of each length, for longer codes.
+        dict2 = struct.unpack_from('>64L', huff, off2)
+        self._mincode = [0]
+        self._maxcode = [0]
+        for codelen in xrange(1, 33):
+            mincode, maxcode = dict2[2*codelen-2:2*codelen]
+            self._mincode.append(mincode << (32 - codelen))
+            self._maxcode.append(((maxcode + 1) << (32 - codelen)) - 1)
+
+    def _LoadCdic(self, cdic):
+        if cdic[0:8] != 'CDIC\x00\x00\x00\x10':
+            raise MobiException('Invalid CDIC record header')
+        phrases, bits = struct.unpack_from('>LL', cdic, 8)
+        count = min(1 << bits, phrases - len(self._dictionary))
+        for offset in struct.unpack_from('>%dH' % count, cdic, 16):
+            length, = UINT16.unpack_from(cdic, 16 + offset)
+            # The high bit is set if the phrase is stored uncompressed.
+            start = 18 + offset
+            end = start + (length & 0x7FFF)
+            self._dictionary.append((str(cdic[start:end]),
+                                     bool(length & 0x8000)))
+
+    def Unpack(self, data):
+        """Returns the decompressed text of data."""
+        dict1 = self._dict1
+        mincodes = self._mincode
+        maxcodes = self._maxcode
+        dictionary = self._dictionary
+        unpack = UINT64.unpack_from
+        bitsleft = len(data) * 8
+        data = str(data) + '\x00' * 8
+        pos = 0
+        x, = unpack(data, pos)
+        n = 32
+        parts = []
+        append = parts.append
+        while True:
+            if n <= 0:
+                pos += 4
+                x, = unpack(data, pos)
+                n += 32
+            code = (x >> n) & 0xFFFFFFFF
+            codelen, term, maxcode = dict1[code >> 24]
+            if not term:
+                while code < mincodes[codelen]:
+                    codelen += 1
+                    if codelen > 32:
+                        raise MobiException('Invalid HUFF code')
+                maxcode = maxcodes[codelen]
+            n -= codelen
+            bitsleft -= codelen
+            if bitsleft < 0:
+                break
+            index = (maxcode - code) >> (32 - codelen)
+            entry = dictionary[index]
+            if entry is None:
+                raise MobiException('Self-referencing CDIC phrase')
+            phrase, expanded = entry
+            if not expanded:
+                dictionary[index] = None
+                phrase = self.Unpack(phrase)
+                dictionary[index] = (phrase, True)
+            append(phrase)
+        return ''.join(parts)
+
+
+class TextRecordIndex(object):
+    """Maps positions in the uncompressed text of a book to text records.
+
+    Holds the offset in the text at which each text record starts, so a
+    position can be found with a bisect rather than by decompressing all the
+    records before it.
+    """
+
+    def __init__(self, lengths):
+        """lengths is the uncompressed length of each text record."""
+        self._starts = array('L')
+        total = 0
+        for length in lengths:
+            self._starts.append(total)
+            total += length
+        self.text_length = total
+
+    @classmethod
+    def FromHeader(cls, txt_records, record_size, text_length):
+        """Build an index assuming every record but the last is full size."""
+        if not txt_records:
+            return cls([])
+        lengths = [record_size] * (txt_records - 1)
+        lengths.append(max(text_length - record_size * (txt_records - 1), 0))
+        return cls(lengths)
+
+    def GetRecordForPosition(self, position):
+        """Return (record index, offset in the record) for position.
+
+        Positions outside the text are clamped to the first or last record.
+        """
+        i = max(bisect_right(self._starts, max(position, 0)) - 1, 0)
+        return i, position - self._starts[i]
+
+    def GetRecordStart(self, index):
+        return self._starts[index]
+
+    def __len__(self):
+        return len(self._starts)
+
+
+def DecodeForwardInt(data, pos):
+    """Decode a forward encoded variable width integer at pos in data.
+
+    Each byte holds 7 bits of the value, most significant first, and the high
+    bit is set on the last byte. Returns (value, position after it).
+    """
+    value = 0
+    while pos < len(data):
+        byte = ord(data[pos])
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte & 0x80:
+            break
+    return value, pos
+
+
+def _CountBits(value):
+    return bin(value).count('1')
+
+
+class IndexReader(object):
+    """Reads the entries of a MOBI INDX index, such as the NCX.
+
+    The primary INDX record describes the index and holds the TAGX table,
+    which says how the tag values of each entry are encoded. It is followed
+    by the records of entries (each with an IDXT table of entry offsets), and
+    then by the CNCX records holding any strings the entries refer to.
+    """
+
+    # Fields of the INDX record header, after the 'INDX' magic.
+    HEADER_FIELDS = ('length', 'nul1', 'type', 'gen', 'start', 'count',
+                     'code', 'lng', 'total', 'ordt', 'ligt', 'nligt',
+                     'ncncx')
+
+    def __init__(self, book, section):
+        self._book = book
+        self._section = section
+        primary = book.loadSection(section)
+        self.header = self._ParseHeader(primary)
+        self._ParseTagx(primary, self.header['length'])
+        self._cncx_section = section + 1 + self.header['count']
+        # CNCX records, loaded as they are first needed.
+        self._cncx = {}
+
+    def _ParseHeader(self, data):
+        if data[:4] != 'INDX':
+            raise MobiException('Invalid INDX record')
+        values = struct.unpack_from('>%dL' % len(self.HEADER_FIELDS), data, 4)
+        return dict(zip(self.HEADER_FIELDS, values))
+
+    def _ParseTagx(self, data, offset):
+        if data[offset:offset+4] != 'TAGX':
+            raise MobiException('Invalid TAGX table')
+        length, self._control_bytes = struct.unpack_from('>LL', data,
+                                                         offset + 4)
+        count = (length - 12) / 4
+        tags = struct.unpack_from('>%dB' % (count * 4), data, offset + 12)
+        # (tag, values per entry, mask, end of control byte flag)
+        self._tagx = [tags[i:i+4] for i in xrange(0, len(tags), 4)]
+
+    def _ParseTags(self, data, pos, end):
+        """Decode the control bytes and tag values of an entry."""
+        control = [ord(c) for c in data[pos:pos + self._control_bytes]]
+        pos += self._control_bytes
+        present = []
+        for tag, per_entry, mask, end_flag in self._tagx:
+            if end_flag & 0x01:
+                control = control[1:]
+                continue
+            if not control:
+                break
+            value = control[0] & mask
+            if not value:
+                continue
+            if value == mask and _CountBits(mask) > 1:
+                # The values take up a given number of bytes.
+                nbytes, pos = DecodeForwardInt(data, pos)
+                present.append((tag, None, nbytes))
+            else:
+                while not mask & 0x01:
+                    mask >>= 1
+                    value >>= 1
+                present.append((tag, value * per_entry, None))
+        tags = {}
+        for tag, count, nbytes in present:
+            values = []
+            if count is not None:
+                for _ in xrange(count):
+                    value, pos = DecodeForwardInt(data, pos)
+                    values.append(value)
+            else:
+                stop = min(pos + nbytes, end)
+                while pos < stop:
+                    value, pos = DecodeForwardInt(data, pos)
+                    values.append(value)
+            tags[tag] = values
+        return tags
+
+    def GetEntries(self):
+        """Yield (name, tags) for each entry, where tags maps tag => values."""
+        for i in xrange(self.header['count']):
+            data = self._book.loadSection(self._section + 1 + i)
+            header = self._ParseHeader(data)
+            idxt = header['start']
+            if data[idxt:idxt+4] != 'IDXT':
+                raise MobiException('Invalid IDXT table')
+            offsets = list(struct.unpack_from('>%dH' % header['count'], data,
+                                              idxt + 4))
+            offsets.append(idxt)
+            for start, end in zip(offsets, offsets[1:]):
+                length = ord(data[start])
+                name = data[start+1:start+1+length]
+                yield name, self._ParseTags(data, start + 1 + length, end)
+
+    def GetString(self, offset):
+        """Return the string at offset in the CNCX records."""
+        record, pos = offset >> 16, offset & 0xFFFF
+        if record >= self.header['ncncx']:
+            raise MobiException('CNCX offset %x out of range' % offset)
+        data = self._cncx.get(record)
+        if data is None:
+            data = self._book.loadSection(self._cncx_section + record)
+            self._cncx[record] = data
+        length, pos = DecodeForwardInt(data, pos)
+        return data[pos:pos + length]
+
+
+class ChapterIndex(object):
+    """The chapters of a book, from its NCX, sorted by text position."""
+
+    def __init__(self, chapters):
+        """chapters is a list of (offset, depth, title) tuples."""
+        chapters = sorted(chapters)
+        self._offsets = array('L', [c[0] for c in chapters])
+        self.depths = [c[1] for c in chapters]
+        self.titles = [c[2] for c in chapters]
+
+    def GetChapterForPosition(self, position, max_depth=None):
+        """Return the index of the chapter containing position, or -1.
+
+        If max_depth is given, deeper (sub-)chapters are ignored.
+        """
+        i = bisect_right(self._offsets, position) - 1
+        if max_depth is not None:
+            while i >= 0 and self.depths[i] > max_depth:
+                i -= 1
+        return i
+
+    def GetTitleForPosition(self, position, max_depth=None):
+        i = self.GetChapterForPosition(position, max_depth)
+        if i < 0:
+            return None
+        return self.titles[i]
+
+    def GetChapterStart(self, index):
+        return self._offsets[index]
+
+    def __len__(self):
+        return len(self._offsets)
+
+
+class MobiMetadata(object):
+    """The EXTH records of a book, each decoded the first time it is used.
+
+    records maps EXTH record types to the list of raw values of that type, in
+    the order they appear. Fields are read as attributes named after the
+    lowercased names in EXTH_MAP_STRINGS, e.g. metadata.creator, and are
+    unicode strings with multiple values joined by '; '. A decoded field is
+    stored in its slot, so later reads don't decode it again.
+    """
+
+    __slots__ = ('_records', 'encoding') + tuple(sorted(EXTH_RMAP_STRINGS))
+
+    def __init__(self, records, encoding=DEFAULT_ENCODING):
+        self._records = records
+        self.encoding = encoding
+
+    def _Decode(self, exth_type, value):
+        if exth_type in EXTH_MAP_CONVERSIONS:
+            value, = struct.unpack(EXTH_MAP_CONVERSIONS[exth_type], value)
+            value = str(value)
+        return unicode(value, self.encoding)
+
+    def GetValues(self, name):
+        """Returns the decoded values of the field name, as a list."""
+        exth_type = EXTH_RMAP_STRINGS[name]
+        return [self._Decode(exth_type, value)
+                for value in self._records.get(exth_type, [])]
+
+    def GetRaw(self, exth_type):
+        """Returns the undecoded values of EXTH records of exth_type."""
+        return self._records.get(exth_type, [])
+
+    def __getattr__(self, name):
+        # Only called for fields whose slot is still empty.
+        if name not in EXTH_RMAP_STRINGS:
+            raise AttributeError(name)
+        value = u'; '.join(self.GetValues(name))
+        setattr(self, name, value)
+        return value
+
+
+def GetTrailingEntriesSize(data, flags):
+    """Return the size of the trailing entries at the end of a text record.
+
+    Each bit set in flags (above bit 0) indicates a trailing entry, which ends
+    with its size encoded backwards. Bit 0 indicates multibyte character
+    overlap bytes, whose count is in the low bits of the byte preceding the
+    other entries.
+    """
+    def _EntrySize(size):
+        bitpos = 0
+        result = 0
+        while size > 0:
+            v = ord(data[size - 1])
+            result |= (v & 0x7F) << bitpos
+            bitpos += 7
+            size -= 1
+            if (v & 0x80) or bitpos >= 28:
+                break
+        return result
+
+    num = 0
+    size = len(data)
+    testflags = flags >> 1
+    while testflags:
+        if testflags & 1:
+            num += _EntrySize(size - num)
+        testflags >>= 1
+    if flags & 1 and size - num > 0:
+        num += (ord(data[size - num - 1]) & 0x3) + 1
+    return num
+
+
 class MobiBook(object):
 
-    def __init__(self, infile):
-        """Load and parse the bytes in infile, an opened file-like object."""
+    # Number of decompressed text records to keep in memory.
+    TEXT_CACHE_RECORDS = 32
+
+    def __init__(self, infile, lazy=False, use_mmap=False):
+        """Load and parse the bytes in infile, an opened file-like object.
+
+        If lazy is True, only the header, section table and record 0 are read
+        from infile up front, and other sections are read from it as they are
+        loaded. infile must be seekable, and stay open while the book is used.
+
+        If use_mmap is True, infile (which must be a real file) is memory
+        mapped, and sections are returned as read-only buffer objects over the
+        mapping rather than copied into new strings. The mapping is held until
+        close() is called.
+        """
+        self._mmap = None
+        self._infile = None
+        if use_mmap:
+            self.data_file = None
+            self._mmap = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            self._length = len(self._mmap)
+        elif lazy:
+            self.data_file = None
+            self._infile = infile
+            infile.seek(0, os.SEEK_END)
+            self._length = infile.tell()
+        else:
+            self.data_file = infile.read()
+            self._length = len(self.data_file)
         # initial sanity check on file
-        self.data_file = infile.read()
-        self.header = self.data_file[0:78]
+        self.header = self._ReadRange(0, 78)
         self.magic = self.header[0x3C:0x3C+8]
         if self.magic != 'BOOKMOBI':
             raise MobiException("invalid file format")
@@ -82,52 +553,70 @@ class MobiBook(object):
 
         # parse information from section 0
         self.record0 = self.loadSection(0)
-        self.compression, = struct.unpack('>H', self.record0[0x0:0x0+2])
-        self.txt_records, = struct.unpack('>H', self.record0[0x8:0x8+2])
+        self.compression, = UINT16.unpack_from(self.record0, 0x0)
+        self.txt_records, = UINT16.unpack_from(self.record0, 0x8)
+        self.text_length, = UINT32.unpack_from(self.record0, 0x4)
+        self.text_record_size, = UINT16.unpack_from(self.record0, 0xA)
         self.firstimg = self.txt_records + 1
         self.extra_data_flags = 0
         self.meta_array = {}
+        self.metadata = MobiMetadata({})
+        self._title = None
         self.mobi_length = 0
         self.mobi_version = -1
         self.print_replica = False
+        self._text_cache = LRUCache(self.TEXT_CACHE_RECORDS)
+        self._huff_reader = None
+        self._text_index = None
 
         self.parseMobiHeader()
 
     def parseMobiHeader(self):
-        self.mobi_length, = struct.unpack('>L',self.record0[0x14:0x18])
-        self.mobi_codepage, = struct.unpack('>L',self.record0[0x1c:0x20])
-        self.mobi_version, = struct.unpack('>L',self.record0[0x68:0x6C])
+        self.mobi_length, = UINT32.unpack_from(self.record0, 0x14)
+        self.mobi_codepage, = UINT32.unpack_from(self.record0, 0x1c)
+        self.encoding = CODEPAGE_MAP.get(self.mobi_codepage, DEFAULT_ENCODING)
+        self.mobi_version, = UINT32.unpack_from(self.record0, 0x68)
         self.exth_off = self.mobi_length + 16  # EXTH block offset, if any.
-        self.firstimg, = struct.unpack_from('>L',self.record0, 0x6C)
+        self.firstimg, = UINT32.unpack_from(self.record0, 0x6C)
+        # The first HUFF/CDIC record, and how many there are.
+        self.huff_offset, self.huff_count = struct.unpack_from(
+                '>LL', self.record0, 0x70)
+        # The NCX index record, if any.
+        self.ncx_index = 0xFFFFFFFF
+        if self.mobi_length >= 0xE8:
+            self.ncx_index, = UINT32.unpack_from(self.record0, 0xF4)
  
         # Extract the extra_data_flags, indicating if there is extra data
         # present at the end of each text record.
         if (self.mobi_length >= 0xE4) and (self.mobi_version >= 5):
-           self.extra_data_flags, = struct.unpack('>H', self.record0[0xF2:0xF4])
+           self.extra_data_flags, = UINT16.unpack_from(self.record0, 0xF2)
         
         # Extract the DRM and Crypto information.
-        self.crypto_type, = struct.unpack('>H', self.record0[0xC:0xC+2])
-        self.drm_ptr, self.drm_count, self.drm_size, _ = struct.unpack('>LLLL',
-                self.record0[0xA8:0xA8+16])
+        self.crypto_type, = UINT16.unpack_from(self.record0, 0xC)
+        self.drm_ptr, self.drm_count, self.drm_size, _ = struct.unpack_from(
+                '>LLLL', self.record0, 0xA8)
 
         # Try and parse any EXTH data that is present.
-        exth_flag, = struct.unpack('>L', self.record0[0x80:0x84])
+        exth_flag, = UINT32.unpack_from(self.record0, 0x80)
         if exth_flag & 0x40:
             if not self.processEXTH(self.storeEXTH):
                 self.meta_array = {}
+        self.metadata = MobiMetadata(self.meta_array, self.encoding)
 
     def processEXTH(self, callback):
         try:
-            exth = self.record0[self.exth_off:]
-            if len(exth) < 12 or exth[:4] != 'EXTH':
+            exth_off = self.exth_off
+            if (len(self.record0) < exth_off + 12 or
+                    self.record0[exth_off:exth_off + 4] != 'EXTH'):
                 logger.warn(u'Could not find expected EXTH record!')
                 return
 
-            nitems, = struct.unpack('>I', exth[8:12])
+            nitems, = UINT32.unpack_from(self.record0, exth_off + 8)
             pos = 12
             for i in xrange(nitems):
-                exth_type, size = struct.unpack('>II', exth[pos: pos + 8])
-                content = exth[pos + 8: pos + size]
+                start = exth_off + pos
+                exth_type, size = EXTH_RECORD.unpack_from(self.record0, start)
+                content = self.record0[start + 8:start + size]
                 callback(exth_type, pos, content)
                 pos += size
         except:
@@ -136,76 +625,225 @@ class MobiBook(object):
         return True
 
     def storeEXTH(self, exth_type, pos, content):
-        self.meta_array[exth_type] = content
+        self.meta_array.setdefault(exth_type, []).append(content)
+
+    def close(self):
+        """Release the memory mapping of the file, if there is one.
+
+        The header and metadata stay available, but no more sections can be
+        loaded. Buffers previously returned by loadSection become invalid.
+        """
+        if self._mmap is None:
+            return
+        self.header = str(self.header)
+        self.record0 = str(self.record0)
+        self._mmap.close()
+        self._mmap = None
+
+    def _ReadRange(self, start, end):
+        """Returns the raw bytes from start to end in the file."""
+        if self.data_file is not None:
+            return self.data_file[start:end]
+        if self._mmap is not None:
+            start = min(start, self._length)
+            return buffer(self._mmap, start, max(end - start, 0))
+        if self._infile is None:
+            raise MobiException('The book file has been closed')
+        self._infile.seek(start)
+        return self._infile.read(end - start)
 
     def parseSections(self):
         """Build a list of section description tuples for all sections."""
-        self.num_sections, = struct.unpack('>H', self.header[76:78])
-        self.sections = []
-        for i in xrange(self.num_sections):
-            offset, a1, a2, a3, a4 = struct.unpack('>LBBBB',
-                    self.data_file[78+i*8:78+i*8+8])
-            flags, uniqueID = a1, a2<<16|a3<<8|a4
-            self.sections.append((offset, flags, uniqueID))
+        self.num_sections, = UINT16.unpack_from(self.header, 76)
+        section_table = self._ReadRange(78, 78 + self.num_sections * 8)
+        # Each entry is the offset, then the flags byte and 3 byte unique ID.
+        # Decode the whole table in one go, as pairs of longs.
+        entries = struct.unpack_from('>%dL' % (2 * self.num_sections),
+                                     section_table)
+        self.sections = [(offset, attrs >> 24, attrs & 0xFFFFFF)
+                         for offset, attrs in zip(entries[0::2],
+                                                  entries[1::2])]
 
     def loadSection(self, section):
-        """Returns raw bytes for the specified section."""
+        """Returns raw bytes for the specified section.
+
+        In mmap mode the bytes are a read-only buffer over the file.
+        """
         if (section + 1 == self.num_sections):
-            endoff = len(self.data_file)
+            endoff = self._length
         else:
             endoff = self.sections[section + 1][0]
         off = self.sections[section][0]
-        return self.data_file[off:endoff]
+        return self._ReadRange(off, endoff)
+
+    def _DecompressRecord(self, data):
+        if self.compression == COMPRESSION_PALMDOC:
+            return UncompressPalmDOC(data)
+        elif self.compression == COMPRESSION_HUFFDIC:
+            if self._huff_reader is None:
+                if self.huff_count < 1:
+                    raise MobiException('No HUFF/CDIC records found')
+                self._huff_reader = HuffcdicReader(
+                        self.loadSection(self.huff_offset),
+                        [self.loadSection(self.huff_offset + i)
+                         for i in xrange(1, self.huff_count)])
+            return self._huff_reader.Unpack(data)
+        elif self.compression == COMPRESSION_NONE:
+            return str(data)
+        raise MobiException('Unsupported compression type %d' %
+                            self.compression)
+
+    def GetTextRecord(self, index):
+        """Returns the decompressed text of text record index (from 0).
+
+        Trailing entries are stripped, and recently used records are cached.
+        """
+        if index < 0 or index >= self.txt_records:
+            raise MobiException('Text record %d out of range (%d records)' %
+                                (index, self.txt_records))
+        text = self._text_cache.Get(index)
+        if text is not None:
+            return text
+        if self.crypto_type != CRYPTO_NONE:
+            raise MobiException('Cannot read text from an encrypted book')
+        data = self.loadSection(index + 1)
+        trailing = GetTrailingEntriesSize(data, self.extra_data_flags)
+        text = self._DecompressRecord(data[:len(data) - trailing])
+        self._text_cache.Set(index, text)
+        return text
+
+    def GetChapterIndex(self):
+        """Returns a ChapterIndex from the book's NCX, or None if it has none.
+
+        Chapter titles are decoded to unicode.
+        """
+        if self.ncx_index == 0xFFFFFFFF or self.ncx_index >= self.num_sections:
+            return None
+        reader = IndexReader(self, self.ncx_index)
+        chapters = []
+        for name, tags in reader.GetEntries():
+            if 1 not in tags:
+                continue
+            if 3 in tags:
+                title = reader.GetString(tags[3][0])
+            else:
+                title = name
+            depth = tags.get(4, [0])[0]
+            chapters.append((tags[1][0], depth,
+                             unicode(title, self.encoding, 'replace')))
+        return ChapterIndex(chapters)
+
+    def GetTextIndex(self, exact=False):
+        """Returns a TextRecordIndex for the text records of the book.
+
+        By default the index is built from the text length and record size in
+        the header, which is cheap. If exact is True every record is
+        decompressed to find its real length instead.
+        """
+        if exact:
+            self._text_index = TextRecordIndex(
+                    [len(self.GetTextRecord(i))
+                     for i in xrange(self.txt_records)])
+        elif self._text_index is None:
+            self._text_index = TextRecordIndex.FromHeader(
+                    self.txt_records, self.text_record_size, self.text_length)
+        return self._text_index
+
+    def SetTextIndex(self, text_index):
+        """Use text_index (e.g. a cached exact index) for text lookups."""
+        self._text_index = text_index
+
+    def GetTextAt(self, position, length):
+        """Returns up to length bytes of uncompressed text from position.
+
+        Only the text records covering the range are decompressed.
+        """
+        text_index = self.GetTextIndex()
+        if not len(text_index) or length <= 0:
+            return ''
+        index, offset = text_index.GetRecordForPosition(position)
+        if offset < 0:
+            length += offset
+            offset = 0
+        parts = []
+        while length > 0 and index < self.txt_records:
+            text = self.GetTextRecord(index)[offset:offset + length]
+            parts.append(text)
+            length -= len(text)
+            index += 1
+            offset = 0
+        return ''.join(parts)
 
     def __getattr__(self, name):
         if name not in EXTH_RMAP_STRINGS:
             logger.debug(u'No attribute named: %s', name)
             raise AttributeError
-        tag = EXTH_RMAP_STRINGS[name]
-        v = self.meta_array.get(tag, '')
-        if tag in EXTH_MAP_CONVERSIONS and v:
-            v, = struct.unpack(EXTH_MAP_CONVERSIONS[tag], v)
-            v = str(v)
-        encoding = CODEPAGE_MAP.get(self.mobi_codepage, DEFAULT_ENCODING)
-        return unicode(v, encoding)
+        return getattr(self.metadata, name)
 
     @property
     def title(self):
+        if self._title is not None:
+            return self._title
         title = self.updatedtitle
-        encoding = CODEPAGE_MAP.get(self.mobi_codepage, DEFAULT_ENCODING)
         if not title:
-            toff, tlen = struct.unpack('>II', self.record0[0x54:0x5c])
-            title = unicode(self.record0[toff:toff+tlen], encoding)
+            toff, tlen = struct.unpack_from('>II', self.record0, 0x54)
+            title = unicode(self.record0[toff:toff+tlen], self.encoding)
         title = title.strip()
         if not title:
             title = self.header[:32].strip()
-            title = unicode(title.split('\0')[0], encoding)
+            title = unicode(title.split('\0')[0], self.encoding)
+        self._title = title
         return title
 
 
+def DescribeBook(filename):
+    """Returns an OrderedDict describing the book in filename.
+
+    Fields with several values are given as a list. If the book can't be read,
+    the error is returned under 'error' instead.
+    """
+    info = OrderedDict([('file', filename)])
+    try:
+        fp = open(filename, 'rb')
+        try:
+            book = MobiBook(fp, lazy=True)
+            info['title'] = book.title
+            for name in EXTH_RMAP_STRINGS:
+                values = book.metadata.GetValues(name)
+                if len(values) > 1:
+                    info[name] = values
+                elif values and values[0]:
+                    info[name] = values[0]
+        finally:
+            fp.close()
+    except Exception, e:
+        info['error'] = '%s: %s' % (e.__class__.__name__, e)
+    return info
+
+
+def PrintBook(info):
+    print '%s: %s' % ('File'.rjust(15), info['file'])
+    if 'error' in info:
+        print '%s: %s' % ('Error'.rjust(15), info['error'])
+        return
+    print '%s: %s' % ('Title'.rjust(15), info['title'])
+    for name, v in info.items()[2:]:
+        if isinstance(v, list):
+            v = '; '.join(v)
+        print '%s: %s' % (name.rjust(15), v)
+
+
 def main():
-    if len(sys.argv) < 2:
+    logging.basicConfig()
+    options, args = batch.ParseOptions(sys.argv, 'books')
+    if len(args) < 2:
         logging.fatal('You must specify a book to parse!')
         sys.exit(1)
-
-    logging.basicConfig()
-    if sys.argv[1] == '-d':
+    if options.debug:
         logger.setLevel(logging.DEBUG)
-        sys.argv.remove('-d')
-
-    fp = open(sys.argv[1], 'r')
-    book = MobiBook(fp)
-    
-    print '%s: %s' % ('File'.rjust(15), sys.argv[1])
-    print '%s: %s' % ('Title'.rjust(15), book.title)
-    for name in EXTH_RMAP_STRINGS:
-        try:
-            v = getattr(book, name)
-        except AttributeError, e:
-            v = 'ERROR: %s' % e
-        if v:
-            print '%s: %s' % (name.rjust(15), v)
+    batch.RunBatch(options, args[1:], ('.azw', '.azw3', '.mobi', '.prc'),
+                   DescribeBook, PrintBook)
 
 
 if __name__ == '__main__':
-    main()        
+    main()